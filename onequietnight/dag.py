@@ -0,0 +1,266 @@
+"""Run the stages of the daily pipeline as a memoized dependency graph.
+
+Each stage declares the stages it depends on. After a stage runs, a content
+hash of its output is recorded in dag_state.json in today's partition,
+together with the hashes of the inputs it ran on. On the next run a stage
+is skipped when the hashes of its inputs did not change, and it is only
+loaded from today's partition if a stage depending on it has to run.
+Stages whose dependencies are done run concurrently in threads, except for
+the fits of the model stages, which take turns (see
+onequietnight.env.sampling_lock) and are parallelized over env.n_jobs
+worker processes instead.
+
+    dag.run(env)                                # everything
+    dag.run(env, targets=["models:county"])     # data, features, county models
+    dag.run(env, force=["features"])            # rerun features
+    dag.run(env, force=["data"])                # download data again
+"""
+
+import hashlib
+import json
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import pandas as pd
+from onequietnight.config import model_configs
+from onequietnight.data.io import get_date_partition
+
+logger = logging.getLogger(__name__)
+
+dag_state_filename = "dag_state.json"
+
+
+class Stage:
+    """A stage of the graph.
+
+    run: function of the environment that computes the stage.
+    deps: names of the stages whose output `run` uses.
+    output_hash: function of the environment returning the hash of the
+        stage's output after it ran or was loaded.
+    load: optional function of the environment that loads the output of an
+        up to date stage for the stages that depend on it. Stages without it
+        always run when they are needed, or have no dependents.
+    forced_run: optional function of the environment that runs the stage
+        when it is forced, e.g. to download data again instead of reading
+        it from today's partition. `run` by default.
+    """
+
+    def __init__(
+        self,
+        name,
+        run,
+        deps=(),
+        output_hash=None,
+        load=None,
+        always=False,
+        forced_run=None,
+    ):
+        self.name = name
+        self.run = run
+        self.forced_run = forced_run or run
+        self.deps = list(deps)
+        self.output_hash = output_hash
+        self.load = load
+        # Stages that always run, e.g. to check for new data.
+        self.always = always
+
+
+def hash_frames(frames):
+    """Return the sha256 hex digest of a dict of dataframes."""
+    digest = hashlib.sha256()
+    for name in sorted(frames):
+        df = frames[name]
+        digest.update(name.encode())
+        digest.update(repr(list(df.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()
+
+
+def hash_features(env):
+    return hash_frames(
+        {
+            f"{universe}/{name}": dm
+            for universe, features in env.features.items()
+            for name, dm in features.items()
+        }
+    )
+
+
+def hash_models(env, universe):
+    """Hash the fingerprints of the models of `universe`."""
+    fingerprints = [
+        str(getattr(model_pipeline, "fingerprint", None))
+        for _, model_pipeline in sorted(env.models[universe].items())
+    ]
+    return hashlib.sha256(" ".join(fingerprints).encode()).hexdigest()
+
+
+def get_stages():
+    """Return the stages of the daily pipeline by name."""
+    stages = [
+        Stage(
+            "data",
+            lambda env: env.get_data(),
+            output_hash=lambda env: hash_frames(env.data),
+            always=True,
+            forced_run=lambda env: env.get_data(force=True),
+        ),
+        Stage(
+            "features",
+            lambda env: env.get_features(force=True),
+            deps=["data"],
+            output_hash=hash_features,
+            load=lambda env: env.get_features(),
+        ),
+    ]
+    for universe in model_configs:
+        stages.append(
+            Stage(
+                f"models:{universe}",
+                lambda env, universe=universe: env.train_models(
+                    universes=[universe], force=True, save=False
+                ),
+                deps=["data", "features"],
+                output_hash=lambda env, universe=universe: hash_models(env, universe),
+                load=lambda env, universe=universe: env.train_models(
+                    universes=[universe], save=False
+                ),
+            )
+        )
+    models = [f"models:{universe}" for universe in model_configs]
+    stages += [
+        # The model stages can run concurrently, so the store of all their
+        # models is written once after they are done.
+        Stage("model_store", lambda env: env.save_models(), deps=models),
+        # The model stages do not hash their instances, so the stages
+        # predicting with them depend on the features and data as well.
+        Stage(
+            "visualization",
+            lambda env: env.save_visualization_data(),
+            deps=["data", "features"] + models,
+        ),
+        Stage(
+            "covidhub",
+            lambda env: env.save_covidhub_data(),
+            deps=["data", "features"] + models,
+        ),
+    ]
+    return {stage.name: stage for stage in stages}
+
+
+def get_needed(stages, targets):
+    """Return the names of `targets` and of the stages they depend on."""
+    needed = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(stages[name].deps)
+    return needed
+
+
+def read_state(env):
+    if not env.write:
+        return {}
+    path = Path(get_date_partition(env), dag_state_filename)
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_state(env, state):
+    if not env.write:
+        return
+    path = Path(get_date_partition(env), dag_state_filename)
+    with open(path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+class Runner:
+    """Run the stages needed for `targets`, skipping the up to date ones."""
+
+    def __init__(self, env, stages, state, force=()):
+        self.env = env
+        self.stages = stages
+        self.state = state
+        self.force = set(force)
+        self.hashes = {}
+        self.loaded = set()
+        self.locks = {name: threading.Lock() for name in stages}
+
+    def ensure_loaded(self, name):
+        """Load the output of a skipped stage, and of its dependencies, once."""
+        for dep in self.stages[name].deps:
+            self.ensure_loaded(dep)
+        with self.locks[name]:
+            if name in self.loaded:
+                return
+            logger.info(f"Loading {name}.")
+            self.stages[name].load(self.env)
+            self.loaded.add(name)
+
+    def is_up_to_date(self, stage, inputs):
+        recorded = self.state.get(stage.name)
+        return (
+            not stage.always
+            and stage.name not in self.force
+            and recorded is not None
+            and recorded["inputs"] == inputs
+            and (stage.load is not None or stage.output_hash is None)
+        )
+
+    def run_stage(self, name):
+        """Run or skip a stage whose dependencies are done. Return its state."""
+        stage = self.stages[name]
+        inputs = {dep: self.hashes[dep] for dep in stage.deps}
+        if self.is_up_to_date(stage, inputs):
+            logger.info(f"{name} is up to date.")
+            return self.state[name]
+        for dep in stage.deps:
+            self.ensure_loaded(dep)
+        logger.info(f"Running {name}.")
+        if name in self.force:
+            stage.forced_run(self.env)
+        else:
+            stage.run(self.env)
+        with self.locks[name]:
+            self.loaded.add(name)
+        output = stage.output_hash(self.env) if stage.output_hash else None
+        return dict(inputs=inputs, output=output)
+
+    def run(self, targets, max_workers=None):
+        needed = get_needed(self.stages, targets)
+        futures = {}
+        with ThreadPoolExecutor(max_workers) as executor:
+            while len(self.hashes) < len(needed):
+                for name in sorted(needed):
+                    ready = all(dep in self.hashes for dep in self.stages[name].deps)
+                    if ready and name not in self.hashes and name not in futures.values():
+                        futures[executor.submit(self.run_stage, name)] = name
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = futures.pop(future)
+                    self.state[name] = future.result()
+                    self.hashes[name] = self.state[name]["output"]
+        return self.state
+
+
+def run(env, targets=None, force=(), max_workers=None):
+    """Run the stages needed for `targets`, all stages by default.
+
+    force: names of stages to rerun even if they are up to date. Forcing
+        "data" downloads the data again.
+    max_workers: maximum number of stages running at the same time.
+    """
+    stages = get_stages()
+    targets = list(stages) if targets is None else targets
+    unknown = (set(targets) | set(force)) - set(stages)
+    assert not unknown, f"Unknown stages {sorted(unknown)}, must be in {list(stages)}."
+    runner = Runner(env, stages, read_state(env), force)
+    state = runner.run(targets, max_workers)
+    write_state(env, state)
+    return state
@@ -1,6 +1,12 @@
+import gzip
+import json
 import logging
+import os
+import shutil
+from contextlib import contextmanager
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
 logger = logging.getLogger(__name__)
@@ -31,9 +37,10 @@ def write_data(env, data):
         df.to_feather(str(data_path))
 
 
-def read_data(env, name):
+def read_data(env, name, partition=None):
+    """Read raw data from today's date partition or from `partition`."""
     assert env.write, "base_path must be specified to read and write data."
-    date_partition = get_date_partition(env)
+    date_partition = partition or get_date_partition(env)
     data_path = Path(date_partition, get_data_filename(env, name))
     if data_path.exists():
         logger.info(f"Reading from {str(data_path)}")
@@ -41,3 +48,81 @@ def read_data(env, name):
     else:
         logger.info(f"Could not find data at {str(data_path)}")
         raise ValueError(f"Could not find data at {str(data_path)}")
+
+
+def get_previous_partition(env, filename):
+    """Return the latest date partition before today containing `filename`.
+
+    Return None if there is no such partition.
+    """
+    if not env.write:
+        return None
+    today = pd.Timestamp(env.today)
+    partitions = []
+    for path in Path(env.base_path).iterdir():
+        try:
+            date = pd.Timestamp(path.name)
+        except ValueError:
+            continue
+        if path.is_dir() and date < today and Path(path, filename).exists():
+            partitions.append((date, path))
+    if not partitions:
+        return None
+    return max(partitions)[1]
+
+
+@contextmanager
+def atomic_path(path):
+    """Yield a temporary path that replaces `path` if the block succeeds.
+
+    Readers of `path` see either the old or the new file, never a partial one.
+    """
+    path = Path(path)
+    temp_path = path.with_name(f".{path.name}.tmp")
+    try:
+        yield temp_path
+        os.replace(str(temp_path), str(path))
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+def link_or_copy(source, destination):
+    """Hard link `destination` to `source`, or copy it across file systems."""
+    destination = Path(destination)
+    if destination.exists():
+        destination.unlink()
+    try:
+        os.link(str(source), str(destination))
+    except OSError:
+        shutil.copyfile(str(source), str(destination))
+
+
+def write_typed_array(dm, directory, name):
+    """Write a dates x locations matrix for the visualization app.
+
+    The values are written row by row as little-endian float32 to a gzipped
+    `name`.bin.gz, which the app reads into a Float32Array, with missing
+    values as NaN. `name`.json indexes it by dates and locations. Return the
+    paths of both files.
+    """
+    data_path = Path(directory, f"{name}.bin.gz")
+    values = np.ascontiguousarray(dm.values, dtype="<f4")
+    with open(data_path, "wb") as f:
+        # mtime=0 so that the same values give the same file.
+        with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=9, mtime=0) as g:
+            g.write(values.tobytes())
+
+    index_path = Path(directory, f"{name}.json")
+    index = dict(
+        data=data_path.name,
+        dtype="float32",
+        byteOrder="little",
+        encoding="gzip",
+        shape=list(values.shape),
+        dates=list(pd.to_datetime(dm.index).strftime("%Y-%m-%d")),
+        locations=[str(location) for location in dm.columns],
+    )
+    with open(index_path, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    return [data_path, index_path]
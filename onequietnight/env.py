@@ -1,14 +1,24 @@
 import logging
+import shutil
+import threading
 from pathlib import Path
 
 import joblib
+import numpy as np
 import pandas as pd
 
 from onequietnight.config import max_weeks_ahead, model_configs
 from onequietnight.data import apple, covidtracking, google, jhu, covidcast
-from onequietnight.data.io import get_date_partition, read_data, write_data
+from onequietnight.data.io import (
+    get_date_partition,
+    get_previous_partition,
+    link_or_copy,
+    read_data,
+    write_data,
+    write_typed_array,
+)
 from onequietnight.data.locations import convert_c3ai_to_jhu, get_locations
-from onequietnight.data.utils import to_dataframe, to_matrix
+from onequietnight.data.utils import to_matrix
 from onequietnight.features import (
     county,
     national,
@@ -16,11 +26,35 @@ from onequietnight.features import (
     transform_data_to_features,
     transform_dates,
 )
-from onequietnight.features.transforms import normalize_cases, select_universe
-from onequietnight.models.forecast import ForecastPipeline
+from onequietnight.features.incremental import update_features
+from onequietnight.features.transforms import select_universe
+from onequietnight.models.compilation import enable_compilation_cache
+from onequietnight.models.model_index import (
+    get_fingerprint,
+    get_instance_fingerprint,
+    read_model,
+    write_model,
+)
+from onequietnight.models.forecast import (
+    ForecastPipeline,
+    fit_batched,
+    fit_model,
+    get_design,
+    predict_model,
+)
+from onequietnight.parallel import run_tasks
 
 logger = logging.getLogger(__name__)
 
+# Serializes writes of the model store.
+models_lock = threading.Lock()
+# Makes threads that need the same forecasts wait for one inference run.
+forecasts_lock = threading.RLock()
+# numpyro traces models with a global stack of effect handlers, so threads
+# take turns to fit and predict in-process. Fits run in parallel in the
+# n_jobs worker processes instead.
+sampling_lock = threading.Lock()
+
 
 def locations_map(locations_df):
     """Return a locations map:
@@ -59,12 +93,26 @@ class OneQuietNightEnvironment:
     # They should be modified in different environments.
     locations_filename = "locations.feather"
     features_filename = "feature_store.joblib"
+    transformed_features_filename = "transformed_feature_store.joblib"
     models_filename = "model_store.joblib"
+    forecasts_filename = "forecast_store.joblib"
     start_date = "2020-01-20"
     load_data_jhu = True
     load_data_covidtracking = True
     load_data_google = True
     load_data_apple = True
+    # Number of worker processes for parallel steps; 1 runs them in-process.
+    n_jobs = 1
+    # Threads per worker process fitting and predicting models when n_jobs
+    # is not 1, see onequietnight.parallel.ThreadLimitedLokyBackend.
+    jax_threads = 1
+    # Compiled models are cached under base_path in this directory, with jax
+    # 0.2.12 or later; see onequietnight.models.compilation.
+    compilation_cache_dirname = "jax_cache"
+    # Training rows are padded to bucket sizes with at most this fraction of
+    # padding, so that the shapes, and the compiled NUTS kernels, stay the
+    # same from day to day.
+    bucket_padding = 0.25
 
     def __init__(self, base_path=None, today=None):
         self.base_path = base_path
@@ -74,7 +122,11 @@ class OneQuietNightEnvironment:
             Path.mkdir(self.base_path, exist_ok=True)
         self.locations_df = self.get_or_create_locations_df()
         self.locations = locations_map(self.locations_df)
+        self.id_locations = self.locations_df.set_index("id")["location"]
         self.data = {}
+        self.designs = {}
+        self.models = {name: {} for name in model_configs}
+        self.forecasts = {}
 
     def get_or_create_locations_df(self):
         if self.write:
@@ -110,44 +162,183 @@ class OneQuietNightEnvironment:
                 source_data = source.load_data(self)
                 self.data = {**self.data, **source_data}
 
-    def get_features(self, force=False):
+    def get_features(self, force=False, incremental=False):
+        """Compute features or read them from today's partition.
+
+        incremental: update the features of the latest previous partition
+            instead of computing them over the full history. Only the dates
+            whose raw data changed since that partition, and new dates, are
+            recomputed. Falls back to a full computation when there is no
+            previous partition to update.
+        """
+        self.designs = {}
+        self.forecasts = {}
         features_df_path = Path(get_date_partition(self), self.features_filename)
         if self.write and features_df_path.exists() and not force:
             logger.info(f"Reading features from {str(features_df_path)}.")
             self.features = joblib.load(str(features_df_path))
+            return
+
+        updated = None
+        if incremental:
+            previous_partition = get_previous_partition(
+                self, self.transformed_features_filename
+            )
+            if previous_partition is not None:
+                logger.info(f"Updating features of {str(previous_partition)}.")
+                updated = update_features(self, previous_partition)
+
+        if updated is not None:
+            transformed_features, self.features = updated
         else:
             features = transform_data_to_features(self, self.data)
             features = transform_dates(self, features)
 
+            transformed_features = {}
             self.features = {}
             for model in [national, state, county]:
                 model_features = model.transform_features(self, features)
+                transformed_features[model.model_name] = model_features
                 model_features = model.clean_features(self, model_features)
                 self.features[model.model_name] = model_features
 
-            if self.write:
-                logger.info(f"Writing features to {str(features_df_path)}.")
-                joblib.dump(self.features, str(features_df_path))
+        if self.write:
+            logger.info(f"Writing features to {str(features_df_path)}.")
+            joblib.dump(self.features, str(features_df_path))
+            transformed_features_path = Path(
+                get_date_partition(self), self.transformed_features_filename
+            )
+            logger.info(f"Writing features to {str(transformed_features_path)}.")
+            joblib.dump(transformed_features, str(transformed_features_path))
+
+    def get_design(self, universe):
+        """Return the design matrix of `universe`, shared by its pipelines.
 
-    def train_models(self, instance_offset=0):
+        It is built on first use from the features and the JHU data, with a
+        target column per horizon. See onequietnight.models.forecast.Design.
+        """
+        if universe not in self.designs:
+            self.designs[universe] = get_design(self, universe)
+        return self.designs[universe]
+
+    def train_models(
+        self,
+        instance_offset=0,
+        batched=False,
+        warm_start=False,
+        universes=None,
+        force=False,
+        save=True,
+    ):
+        """Train a model per universe and horizon, or read them from today's partition.
+
+        batched: fit all horizons of a universe in a single NUTS program
+            instead of one program per horizon. Only applies to the "nuts"
+            engine.
+        warm_start: start NUTS from the posteriors of the models of the
+            previous date partition, with a short warmup, or the full one
+            with numpyro 0.4.1 (see LinearModel.run_nuts). Does not apply to
+            batched fits.
+        universes: optional list of the universes to train, all by default.
+            The models of other universes are kept.
+        force: train even if today's partition has models.
+        save: write the models of all universes to today's partition, see
+            save_models. Threads training universes concurrently should
+            leave this to a single save_models call once all are trained.
+            Their fits take turns, see sampling_lock.
+
+        Models whose configuration and training data did not change since an
+        earlier run are read from the model index instead of being refitted,
+        see onequietnight.models.model_index.
+        """
+        universes = list(model_configs) if universes is None else universes
+        self.forecasts = {}
         models_df_path = Path(get_date_partition(self), self.models_filename)
-        if not instance_offset and self.write and models_df_path.exists():
+        if not instance_offset and self.write and models_df_path.exists() and not force:
             logger.info(f"Reading models from {str(models_df_path)}.")
-            self.models = joblib.load(str(models_df_path))
-        else:
-            self.models = {"national": {}, "state": {}, "county": {}}
-            for name, config in model_configs.items():
-                logger.info(f"Training {name} models.")
-                for n_week_ahead in range(1, max_weeks_ahead + 1):
-                    model_pipeline = ForecastPipeline(
-                        self, **config, **dict(n_week_ahead=n_week_ahead)
+            stored_models = joblib.load(str(models_df_path))
+            if all(stored_models.get(name) for name in universes):
+                for name in universes:
+                    # Stored pipelines do not hold the environment.
+                    for model_pipeline in stored_models[name].values():
+                        model_pipeline.set_env(self)
+                    self.models[name] = stored_models[name]
+                return
+            logger.info(f"{str(models_df_path)} is missing some of {universes}.")
+
+        if self.base_path:
+            enable_compilation_cache(
+                Path(self.base_path, self.compilation_cache_dirname)
+            )
+        previous_models = {}
+        if warm_start:
+            previous_partition = get_previous_partition(self, self.models_filename)
+            if previous_partition is not None:
+                logger.info(f"Warm starting from {str(previous_partition)}.")
+                previous_models = joblib.load(
+                    str(Path(previous_partition, self.models_filename))
+                )
+        models = {}
+        tasks = {}
+        batches = []
+        fitted = []
+        for name in universes:
+            logger.info(f"Training {name} models.")
+            models[name] = {
+                n_week_ahead: ForecastPipeline(
+                    self, **model_configs[name], **dict(n_week_ahead=n_week_ahead)
+                )
+                for n_week_ahead in range(1, max_weeks_ahead + 1)
+            }
+            batch = []
+            for n_week_ahead, model_pipeline in models[name].items():
+                X_train, y_train = model_pipeline.get_training_data(instance_offset)
+                model = model_pipeline.get_model(
+                    previous_models.get(name, {}).get(n_week_ahead)
+                )
+                model_pipeline.fingerprint = get_fingerprint(
+                    model_pipeline, model, X_train, y_train
+                )
+                stored_model = read_model(self, model_pipeline.fingerprint)
+                if stored_model is not None:
+                    model_pipeline.model = stored_model
+                    continue
+                fitted.append(model_pipeline)
+                if batched and model_pipeline.engine == "nuts":
+                    batch.append(model_pipeline)
+                else:
+                    tasks[name, n_week_ahead] = (
+                        fit_model,
+                        model,
+                        X_train,
+                        y_train,
                     )
-                    model_pipeline.fit(instance_offset=instance_offset)
-                    self.models[name][n_week_ahead] = model_pipeline
+            if batch:
+                batches.append(batch)
+        with sampling_lock:
+            for batch in batches:
+                fit_batched(batch, instance_offset=instance_offset)
+            results = run_tasks(tasks, self.n_jobs, self.jax_threads)
+        for (name, n_week_ahead), model in results.items():
+            models[name][n_week_ahead].model = model
+        for model_pipeline in fitted:
+            write_model(self, model_pipeline.fingerprint, model_pipeline.model)
+        # Each universe is replaced at once, so that other threads training
+        # other universes always see complete models.
+        for name in universes:
+            self.models[name] = models[name]
 
-            if not instance_offset and self.write:
-                logger.info(f"Writing models to {str(models_df_path)}.")
-                joblib.dump(self.models, str(models_df_path))
+        if not instance_offset and save:
+            self.save_models()
+
+    def save_models(self):
+        """Write the models of all universes to today's partition."""
+        if not self.write:
+            return
+        models_df_path = Path(get_date_partition(self), self.models_filename)
+        with models_lock:
+            logger.info(f"Writing models to {str(models_df_path)}.")
+            joblib.dump(self.models, str(models_df_path))
 
     def predict(
         self,
@@ -155,25 +346,102 @@ class OneQuietNightEnvironment:
         should_undo_normalize_cases=False,
         instance_offset=0,
     ):
-        forecasts = {}
+        forecasts = self.get_forecasts(instance_offset, should_undo_normalize_cases)
+        forecasts_dfs = {}
         for name in model_configs:
             forecast = []
             for n_week_ahead in range(1, max_weeks_ahead + 1):
-                n_week_ahead_preds = self.models[name][n_week_ahead].predict(
-                    should_undo_normalize_cases=should_undo_normalize_cases,
-                    instance_offset=instance_offset,
+                model_pipeline = self.models[name][n_week_ahead]
+                instance_date, predictions, predictions_proba = forecasts[
+                    name, n_week_ahead
+                ]
+                forecast.append(
+                    model_pipeline.format_predict(instance_date, predictions)
                 )
-                forecast.append(n_week_ahead_preds)
                 if should_predict_proba:
-                    n_week_ahead_preds_proba = self.models[name][
-                        n_week_ahead
-                    ].predict_proba(
-                        should_undo_normalize_cases=should_undo_normalize_cases,
-                        instance_offset=instance_offset,
+                    forecast.append(
+                        model_pipeline.format_predict_proba(
+                            instance_date, predictions_proba
+                        )
+                    )
+            forecasts_dfs[name] = pd.concat(forecast)
+        return forecasts_dfs
+
+    def get_forecasts(self, instance_offset=0, should_undo_normalize_cases=False):
+        """Return the point and quantile forecasts of every pipeline.
+
+        Return a dict of (universe, n_week_ahead) -> (instance_date,
+        predictions, predictions_proba). The posterior predictive is sampled
+        once per instance: the normalized forecasts are cached on the
+        environment, and in today's partition for instance_offset 0, and the
+        forecasts in cases are derived from them.
+        """
+        with forecasts_lock:
+            key = (instance_offset, should_undo_normalize_cases)
+            if key in self.forecasts:
+                return self.forecasts[key]
+            if should_undo_normalize_cases:
+                population = self.locations_df.set_index("id")["population"]
+                forecasts = {}
+                for (name, n_week_ahead), forecast in self.get_forecasts(
+                    instance_offset
+                ).items():
+                    instance_date, predictions, predictions_proba = forecast
+                    design = self.models[name][n_week_ahead].design
+                    _, index = design.instance(instance_date)
+                    scale = population.reindex(index.get_level_values("id")).values
+                    forecasts[name, n_week_ahead] = (
+                        instance_date,
+                        predictions / 1e5 * scale,
+                        (predictions_proba / 1e5).mul(scale, axis=0),
                     )
-                    forecast.append(n_week_ahead_preds_proba)
-            forecasts[name] = pd.concat(forecast)
-        return forecasts
+                self.forecasts[key] = forecasts
+                return forecasts
+
+            instance_dates = {}
+            tasks = {}
+            # The stored forecasts are valid for the same models and instances.
+            fingerprints = {}
+            for name in model_configs:
+                for n_week_ahead in range(1, max_weeks_ahead + 1):
+                    model_pipeline = self.models[name][n_week_ahead]
+                    instance_date, instance_X = model_pipeline.get_instance(
+                        instance_offset=instance_offset
+                    )
+                    instance_dates[name, n_week_ahead] = instance_date
+                    tasks[name, n_week_ahead] = (
+                        predict_model,
+                        model_pipeline.model,
+                        instance_X,
+                        True,
+                    )
+                    fingerprints[name, n_week_ahead] = (
+                        getattr(model_pipeline, "fingerprint", None),
+                        get_instance_fingerprint(instance_date, instance_X),
+                    )
+            forecasts_path = Path(get_date_partition(self), self.forecasts_filename)
+            if not instance_offset and self.write and forecasts_path.exists():
+                stored = joblib.load(str(forecasts_path))
+                has_fingerprints = all(model for model, _ in fingerprints.values())
+                if has_fingerprints and stored["fingerprints"] == fingerprints:
+                    logger.info(f"Reading forecasts from {str(forecasts_path)}.")
+                    self.forecasts[key] = stored["forecasts"]
+                    return self.forecasts[key]
+
+            with sampling_lock:
+                results = run_tasks(tasks, self.n_jobs, self.jax_threads)
+            forecasts = {
+                task_key: (instance_dates[task_key],) + tuple(result)
+                for task_key, result in results.items()
+            }
+            if not instance_offset and self.write:
+                logger.info(f"Writing forecasts to {str(forecasts_path)}.")
+                joblib.dump(
+                    dict(fingerprints=fingerprints, forecasts=forecasts),
+                    str(forecasts_path),
+                )
+            self.forecasts[key] = forecasts
+            return forecasts
 
     def save_covidhub_data(self, instance_offset=0):
         forecasts = self.predict(
@@ -181,10 +449,18 @@ class OneQuietNightEnvironment:
             should_undo_normalize_cases=True,
             instance_offset=instance_offset,
         )
-        forecasts_df = pd.concat(forecasts.values())
-        forecasts_df = pd.merge(
-            forecasts_df, self.locations_df[["id", "location"]], on="id", how="left"
-        ).drop(columns=["id"])
+        forecasts_df = pd.concat(forecasts.values(), ignore_index=True)
+        forecasts_df["location"] = self.id_locations.reindex(forecasts_df["id"]).values
+        # Sort rows in the hub order, by target, then target_end_date,
+        # location, type and quantile, with a stable lexsort on the codes of
+        # each key. The last key of np.lexsort is the primary one, so the keys
+        # are listed from quantile to target.
+        sort_keys = []
+        for column in ["type", "location", "target_end_date", "target"]:
+            codes = pd.factorize(forecasts_df[column], sort=True)[0]
+            # Missing values last, as with sort_values.
+            sort_keys.append(np.where(codes < 0, len(codes), codes))
+        order = np.lexsort([forecasts_df["quantile"].values] + sort_keys)
         cols = [
             "forecast_date",
             "target",
@@ -194,12 +470,8 @@ class OneQuietNightEnvironment:
             "quantile",
             "value",
         ]
-        forecasts_df = forecasts_df[cols]
-        forecasts_df = forecasts_df.sort_values(
-            ["target", "target_end_date", "location", "type", "quantile"]
-        )
-        forecasts_df["value"] = forecasts_df["value"].round()
-        forecasts_df["value"] = forecasts_df["value"].clip(0)
+        forecasts_df = forecasts_df[cols].iloc[order]
+        forecasts_df["value"] = forecasts_df["value"].round().clip(0)
         forecasts_df["quantile"] = forecasts_df["quantile"].round(3)
 
         if instance_offset == 0:
@@ -210,9 +482,11 @@ class OneQuietNightEnvironment:
         logger.info(f"Writing to {filepath}")
         forecasts_df.to_csv(filepath, index=False)
 
-        filepath = Path(self.base_path, "data-processed", "OneQuietNight-ML", filename)
-        logger.info(f"Writing to {filepath}")
-        forecasts_df.to_csv(filepath, index=False)
+        hub_filepath = Path(
+            self.base_path, "data-processed", "OneQuietNight-ML", filename
+        )
+        logger.info(f"Writing to {hub_filepath}")
+        link_or_copy(filepath, hub_filepath)
 
     def save_visualization_data(self):
         forecasts = self.predict()
@@ -222,49 +496,57 @@ class OneQuietNightEnvironment:
             df = convert_c3ai_to_jhu(df, self.locations_df)
             df = df.rename(columns={"target_end_date": "dates"})
             df = df.set_index(["dates", "location"])["value"].unstack()
-            filename = f"OQN_IncidentCasesForecast_{name.capitalize()}.csv"
-            filepath = Path(get_date_partition(self), filename)
-            logger.info(f"Writing to {filepath}")
-            df.to_csv(filepath)
-
-            filepath = Path(
-                self.base_path, "vis", "src", "Data", name.capitalize(), filename
+            self.save_visualization_matrix(
+                df, name.capitalize(), f"OQN_IncidentCasesForecast_{name.capitalize()}"
             )
-            Path.mkdir(filepath.parent, parents=True, exist_ok=True)
-            logger.info(f"Writing to {filepath}")
-            df.to_csv(filepath)
 
         dm = self.get_new_cases_per_100k()
         universes = (
             self.locations_df.groupby("locationType")["fips.id"].apply(list).to_dict()
         )
         for universe_name, universe in universes.items():
-            filename = f"JHU_IncidentCases_{universe_name.capitalize()}.csv"
-            filepath = Path(get_date_partition(self), filename)
-            logger.info(f"Writing to {filepath}")
-            select_universe(dm, universe).to_csv(filepath)
-
-            filepath = Path(
-                self.base_path, "vis", "src", "Data", universe_name.capitalize(), filename
+            self.save_visualization_matrix(
+                select_universe(dm, universe),
+                universe_name.capitalize(),
+                f"JHU_IncidentCases_{universe_name.capitalize()}",
             )
-            logger.info(f"Writing to {filepath}")
-            select_universe(dm, universe).to_csv(filepath)
+
+    def save_visualization_matrix(self, dm, universe_name, name):
+        """Write `dm` to today's partition and to the visualization app.
+
+        Writes `name`.csv and its float32 typed array (see write_typed_array)
+        once to today's partition, then copies them to
+        vis/src/Data/`universe_name`.
+        """
+        partition = get_date_partition(self)
+        filepath = Path(partition, f"{name}.csv")
+        logger.info(f"Writing to {filepath}")
+        dm.to_csv(filepath)
+        typed_array_paths = write_typed_array(dm, partition, name)
+
+        directory = Path(self.base_path, "vis", "src", "Data", universe_name)
+        Path.mkdir(directory, parents=True, exist_ok=True)
+        logger.info(f"Copying {name} to {directory}")
+        # A copy rather than a link, as validate_viz appends to the CSV.
+        shutil.copyfile(str(filepath), str(Path(directory, filepath.name)))
+        for path in typed_array_paths:
+            link_or_copy(path, Path(directory, path.name))
 
     def get_new_cases_per_100k(self):
+        """Return new JHU cases per 100k people per week by JHU location.
+
+        Computed on the wide dates x id matrix: populations are broadcast
+        over the columns, which are then renamed to locations.
+        """
         dates = pd.date_range(self.start_date, self.today, freq="W-SAT", name="dates")
         dm = to_matrix(self.data["JHU_ConfirmedCases"])
 
         dm = dm.reindex(dates, method="ffill").diff(1)
-        dm = normalize_cases(dm, self.locations_df)
-        df = (
-            pd.merge(
-                to_dataframe(dm).reset_index(),
-                self.locations_df[["id", "location"]],
-                on="id",
-                how="left",
-            )
-            .drop(columns=["id"])
-            .rename(columns={"location": "id"})
-        )
-        dm = to_matrix(df)
-        return dm
+        population = self.locations_df.set_index("id")["population"]
+        dm = dm / population.reindex(dm.columns).values * 1e5
+
+        locations = self.id_locations.reindex(dm.columns).values
+        dm = dm.loc[:, pd.notna(locations)]
+        dm.columns = pd.Index(locations[pd.notna(locations)], name="id")
+        dm = dm.loc[:, ~dm.columns.duplicated(keep="last")]
+        return dm.sort_index(axis=1)
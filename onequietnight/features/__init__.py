@@ -18,8 +18,8 @@ def transform_data_to_features(env, data):
 
 
 def transform_dates(env, features, dates=None):
-    all_dates = pd.date_range(env.start_date, env.today, name="dates")
-    dates = dates or all_dates
+    if dates is None:
+        dates = pd.date_range(env.start_date, env.today, name="dates")
     out = {}
     for name, dm in features.items():
         dm.index = pd.to_datetime(dm.index)
@@ -2,15 +2,18 @@ import logging
 
 import pandas as pd
 from onequietnight.features.transforms import (
+    cbsa_membership,
     cross_section_cbsa_mean,
-    cross_section_mean,
-    cross_section_state_mean,
     cross_section_winsor,
     get_state_value,
+    impute_hierarchy,
     normalize_beds,
     normalize_cases,
     select_universe,
+    state_ids,
+    state_membership,
 )
+from onequietnight.parallel import run_tasks
 
 logger = logging.getLogger(__name__)
 
@@ -322,11 +325,71 @@ def transform_features(env, features, freq="W-SAT"):
     return out
 
 
+def clean_state_value(
+    name, dm, normalize, locations_df, universe_states, universe_counties, parents
+):
+    """Impute counties with the normalized value of their state."""
+    logger.info(f"Processing {name}.")
+    dm_state = select_universe(dm, universe_states)
+    dm_state = normalize(dm_state, locations_df)
+    dm = select_universe(dm, universe_counties, fill_missing=True)
+    dm = get_state_value(dm, dm_state, parents)
+    dm = dm.clip(0)
+    dm = cross_section_winsor(dm)
+    dm = dm.fillna(0)
+    return dm
+
+
+def clean_cbsa_mean(
+    name, dm, locations_df, universe_states, universe_counties, cbsa, parents
+):
+    """Impute counties with the CBSA mean, then with the state value."""
+    logger.info(f"Processing {name}.")
+    dm_state = select_universe(dm, universe_states)
+    dm_state = normalize_cases(dm_state, locations_df)
+    dm = select_universe(dm, universe_counties, fill_missing=True)
+    dm = normalize_cases(dm, locations_df)
+    dm = select_universe(dm, universe_counties, fill_missing=True)
+    dm = cross_section_cbsa_mean(dm, locations_df, cbsa)
+    dm = dm.fillna(get_state_value(dm, dm_state, parents))
+    dm = dm.clip(0)
+    dm = cross_section_winsor(dm)
+    dm = dm.fillna(0)
+    return dm
+
+
+def clean_cases(name, dm, locations_df, universe_counties):
+    logger.info(f"Processing {name}.")
+    dm = dm.copy()
+    dm = normalize_cases(dm, locations_df)
+    dm = select_universe(dm, universe_counties, fill_missing=True)
+    dm = dm.clip(0)
+    dm = cross_section_winsor(dm)
+    dm = dm.fillna(0)
+    return dm
+
+
+def clean_hierarchy(name, dm, universe_states, universe_counties, cbsa, state, parents):
+    """Impute counties through the CBSA, state and national hierarchy."""
+    logger.info(f"Processing {name}.")
+    dm_state = select_universe(dm, universe_states)
+    dm = select_universe(dm, universe_counties, fill_missing=True)
+    return impute_hierarchy(dm, dm_state, cbsa, state, parents, 5)
+
+
 def clean_features(env, input_features):
+    """Clean county features.
+
+    Features are independent of each other, so they are cleaned in parallel
+    when `env.n_jobs` is not 1. The output keeps the order below.
+    """
     locations_df = env.locations_df
     universe_states = env.locations["state"]
     universe_counties = env.locations["county"]
-    output_features = {}
+    universe_cbsa = cbsa_membership(universe_counties, locations_df)
+    universe_state = state_membership(universe_counties)
+    universe_parents = state_ids(universe_counties)
+    tasks = {}
 
     impute_group_0 = [
         "CovidTrackingProject_ConfirmedHospitalizations.rolling(7).mean()",
@@ -337,15 +400,16 @@ def clean_features(env, input_features):
         "CovidTrackingProject_Ventilator.rolling(7).mean().shift(7)",
     ]
     for name in impute_group_0:
-        logger.info(f"Processing {name}.")
-        dm_state = select_universe(input_features[name], universe_states)
-        dm_state = normalize_beds(dm_state, locations_df)
-        dm = select_universe(input_features[name], universe_counties, fill_missing=True)
-        dm = get_state_value(dm, dm_state)
-        dm = dm.clip(0)
-        dm = cross_section_winsor(dm)
-        dm = dm.fillna(0)
-        output_features[f"{name}.state"] = dm
+        tasks[f"{name}.state"] = (
+            clean_state_value,
+            name,
+            input_features[name],
+            normalize_beds,
+            locations_df,
+            universe_states,
+            universe_counties,
+            universe_parents,
+        )
 
     impute_group_1a = [
         "JHU_ConfirmedCases.diff(7)",
@@ -362,15 +426,16 @@ def clean_features(env, input_features):
         "CovidTrackingProject_PendingTests.rolling(7).mean().shift(7)",
     ]
     for name in impute_group_1a:
-        logger.info(f"Processing {name}.")
-        dm_state = select_universe(input_features[name], universe_states)
-        dm_state = normalize_cases(dm_state, locations_df)
-        dm = select_universe(input_features[name], universe_counties, fill_missing=True)
-        dm = get_state_value(dm, dm_state)
-        dm = dm.clip(0)
-        dm = cross_section_winsor(dm)
-        dm = dm.fillna(0)
-        output_features[f"{name}.state"] = dm
+        tasks[f"{name}.state"] = (
+            clean_state_value,
+            name,
+            input_features[name],
+            normalize_cases,
+            locations_df,
+            universe_states,
+            universe_counties,
+            universe_parents,
+        )
 
     impute_group_1b = [
         "JHU_ConfirmedCases.diff(7)",
@@ -379,17 +444,16 @@ def clean_features(env, input_features):
         "JHU_ConfirmedDeaths.diff(7).shift(7)",
     ]
     for name in impute_group_1b:
-        logger.info(f"Processing {name}.")
-        dm_state = select_universe(input_features[name], universe_states)
-        dm_state = normalize_cases(dm_state, locations_df)
-        dm = select_universe(input_features[name], universe_counties, fill_missing=True)
-        dm = normalize_cases(dm, locations_df)
-        dm = cross_section_cbsa_mean(dm, env.locations_df)
-        dm = dm.fillna(get_state_value(dm, dm_state))
-        dm = dm.clip(0)
-        dm = cross_section_winsor(dm)
-        dm = dm.fillna(0)
-        output_features[f"{name}.cbsa"] = dm
+        tasks[f"{name}.cbsa"] = (
+            clean_cbsa_mean,
+            name,
+            input_features[name],
+            locations_df,
+            universe_states,
+            universe_counties,
+            universe_cbsa,
+            universe_parents,
+        )
 
     impute_group_1 = [
         "JHU_ConfirmedCases",
@@ -399,14 +463,13 @@ def clean_features(env, input_features):
         "JHU_ConfirmedDeaths.diff(7).shift(7)",
     ]
     for name in impute_group_1:
-        logger.info(f"Processing {name}.")
-        dm = input_features[name].copy()
-        dm = normalize_cases(dm, locations_df)
-        dm = select_universe(dm, universe_counties, fill_missing=True)
-        dm = dm.clip(0)
-        dm = cross_section_winsor(dm)
-        dm = dm.fillna(0)
-        output_features[name] = dm
+        tasks[name] = (
+            clean_cases,
+            name,
+            input_features[name],
+            locations_df,
+            universe_counties,
+        )
 
     impute_group_2 = [
         "Apple_DrivingMobility.rolling(7).mean()",
@@ -453,14 +516,14 @@ def clean_features(env, input_features):
     ]
 
     for name in impute_group_2:
-        logger.info(f"Processing {name}.")
-        dm_state = select_universe(input_features[name], universe_states)
-        dm = select_universe(input_features[name], universe_counties, fill_missing=True)
-        dm = dm.fillna(method="ffill")
-        dm = dm.fillna(cross_section_cbsa_mean(dm, locations_df))
-        dm = dm.fillna(get_state_value(dm, dm_state))
-        dm = dm.fillna(cross_section_state_mean(dm))
-        dm = dm.fillna(cross_section_mean(dm))
-        dm = cross_section_winsor(dm, 5)
-        output_features[name] = dm
-    return output_features
+        tasks[name] = (
+            clean_hierarchy,
+            name,
+            input_features[name],
+            universe_states,
+            universe_counties,
+            universe_cbsa,
+            universe_state,
+            universe_parents,
+        )
+    return run_tasks(tasks, env.n_jobs)
@@ -0,0 +1,136 @@
+"""Update the feature store of a previous date partition incrementally.
+
+Features only look back in time: time series transforms reach at most
+`lookback_days` into the past and cleaning is cross sectional per date,
+except for forward fills. When the raw data of a previous partition only
+differ from today's data from some date on, features before that date are
+unchanged and only the rows from that date on need to be recomputed.
+"""
+
+import logging
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+from onequietnight.data.io import read_data
+from onequietnight.data.utils import rename_columns_df, to_matrix
+from onequietnight.features import (
+    county,
+    national,
+    state,
+    transform_data_to_features,
+    transform_dates,
+)
+
+logger = logging.getLogger(__name__)
+
+# Longest lookback of the time series transforms: rolling(7).mean().shift(14)
+# reaches 20 days into the past.
+lookback_days = 21
+
+
+def get_dirty_start(env, previous_partition):
+    """Return the first date whose raw data differ from `previous_partition`.
+
+    Dates after the previous partition's today are always dirty. Return None
+    if the raw data of the previous partition cannot be read.
+    """
+    dirty_start = pd.Timestamp(previous_partition.name) + pd.Timedelta(days=1)
+    for name, df in env.data.items():
+        try:
+            previous = read_data(env, name, previous_partition)
+        except ValueError:
+            return None
+        dm, dm_previous = to_matrix(df), to_matrix(previous)
+        dm.index = pd.to_datetime(dm.index)
+        dm_previous.index = pd.to_datetime(dm_previous.index)
+        dm, dm_previous = dm.align(dm_previous)
+        changed = (dm != dm_previous) & ~(dm.isnull() & dm_previous.isnull())
+        changed_dates = dm.index[changed.any(1)]
+        if len(changed_dates):
+            logger.info(f"{name} changed from {changed_dates[0]}.")
+            dirty_start = min(dirty_start, changed_dates[0])
+    return dirty_start
+
+
+def get_clean_start(features, dirty_start):
+    """Return the first date needed to clean features from `dirty_start` on.
+
+    Cleaning is cross sectional except for forward fills, which carry the
+    last observation of each location into the dirty window. Starting from
+    the earliest of these last observations reproduces the full history.
+    """
+    clean_start = dirty_start
+    for dm in features.values():
+        before = dm[dm.index < dirty_start]
+        observed = before.notnull().values
+        has_observed = observed.any(0)
+        if has_observed.any():
+            last = len(before) - 1 - np.argmax(observed[::-1], axis=0)
+            clean_start = min(clean_start, before.index[last[has_observed].min()])
+    return clean_start
+
+
+def splice(dm_previous, dm, start):
+    """Replace the rows of `dm_previous` from `start` on with those of `dm`."""
+    return pd.concat([dm_previous[dm_previous.index < start], dm[dm.index >= start]])
+
+
+def update_features(env, previous_partition):
+    """Return (transformed_features, features) updated from a previous partition.
+
+    Return None if the previous partition cannot be updated incrementally, in
+    which case the features should be rebuilt from scratch.
+    """
+    dirty_start = get_dirty_start(env, previous_partition)
+    if dirty_start is None:
+        return None
+    window_start = dirty_start - pd.Timedelta(days=lookback_days)
+    if window_start <= pd.Timestamp(env.start_date):
+        return None
+    logger.info(f"Updating features from {dirty_start}.")
+
+    previous_transformed = joblib.load(
+        str(Path(previous_partition, env.transformed_features_filename))
+    )
+    previous_features = joblib.load(
+        str(Path(previous_partition, env.features_filename))
+    )
+
+    data = {}
+    for name, df in env.data.items():
+        df = rename_columns_df(df)
+        data[name] = df[pd.to_datetime(df["dates"]) >= window_start]
+    features = transform_data_to_features(env, data)
+    features = transform_dates(
+        env, features, pd.date_range(window_start, env.today, name="dates")
+    )
+
+    transformed_features = {}
+    cleaned_features = {}
+    for model in [national, state, county]:
+        name = model.model_name
+        model_features = model.transform_features(env, features)
+        if set(model_features) != set(previous_transformed.get(name, {})):
+            return None
+        model_features = {
+            feature_name: splice(previous_transformed[name][feature_name], dm, dirty_start)
+            for feature_name, dm in model_features.items()
+        }
+        transformed_features[name] = model_features
+
+        clean_start = get_clean_start(model_features, dirty_start)
+        logger.info(f"Cleaning {name} features from {clean_start}.")
+        window_features = {
+            feature_name: dm[dm.index >= clean_start]
+            for feature_name, dm in model_features.items()
+        }
+        window_features = model.clean_features(env, window_features)
+        if set(window_features) != set(previous_features.get(name, {})):
+            return None
+        cleaned_features[name] = {
+            feature_name: splice(previous_features[name][feature_name], dm, dirty_start)
+            for feature_name, dm in window_features.items()
+        }
+    return transformed_features, cleaned_features
@@ -9,6 +9,7 @@ from onequietnight.features.transforms import (
     normalize_cases,
     select_universe,
 )
+from onequietnight.parallel import run_tasks
 
 logger = logging.getLogger(__name__)
 
@@ -320,11 +321,39 @@ def transform_features(env, features, freq="W-SAT"):
     return out
 
 
+def clean_normalized(name, dm, normalize, locations_df, universe_states):
+    logger.info(f"Processing {name}.")
+    dm = dm.copy()
+    dm = normalize(dm, locations_df)
+    dm = select_universe(dm, universe_states, fill_missing=True)
+    dm = dm.clip(0)
+    dm = cross_section_winsor(dm)
+    dm = dm.fillna(0)
+    return dm
+
+
+def clean_hierarchy(name, dm, universe_states, universe_national):
+    """Impute states with the national value, then with the mean of states."""
+    logger.info(f"Processing {name}.")
+    dm_national = select_universe(dm, universe_national, fill_missing=True)
+    dm = select_universe(dm, universe_states, fill_missing=True)
+    dm = dm.fillna(method="ffill")
+    dm = dm.fillna(get_national_value(dm, dm_national))
+    dm = dm.fillna(cross_section_mean(dm))
+    dm = cross_section_winsor(dm, 5)
+    return dm
+
+
 def clean_features(env, input_features):
+    """Clean state features.
+
+    Features are independent of each other, so they are cleaned in parallel
+    when `env.n_jobs` is not 1. The output keeps the order below.
+    """
     locations_df = env.locations_df
     universe_states = env.locations["state"]
     universe_national = env.locations["country"]
-    output_features = {}
+    tasks = {}
 
     impute_group_0 = [
         "CovidTrackingProject_ConfirmedHospitalizations.rolling(7).mean()",
@@ -335,14 +364,14 @@ def clean_features(env, input_features):
         "CovidTrackingProject_Ventilator.rolling(7).mean().shift(7)",
     ]
     for name in impute_group_0:
-        logger.info(f"Processing {name}.")
-        dm = input_features[name].copy()
-        dm = normalize_beds(dm, locations_df)
-        dm = select_universe(dm, universe_states, fill_missing=True)
-        dm = dm.clip(0)
-        dm = cross_section_winsor(dm)
-        dm = dm.fillna(0)
-        output_features[name] = dm
+        tasks[name] = (
+            clean_normalized,
+            name,
+            input_features[name],
+            normalize_beds,
+            locations_df,
+            universe_states,
+        )
 
     impute_group_1 = [
         "JHU_ConfirmedCases",
@@ -360,14 +389,14 @@ def clean_features(env, input_features):
         "CovidTrackingProject_PendingTests.rolling(7).mean().shift(7)",
     ]
     for name in impute_group_1:
-        logger.info(f"Processing {name}.")
-        dm = input_features[name].copy()
-        dm = normalize_cases(dm, locations_df)
-        dm = select_universe(dm, universe_states, fill_missing=True)
-        dm = dm.clip(0)
-        dm = cross_section_winsor(dm)
-        dm = dm.fillna(0)
-        output_features[name] = dm
+        tasks[name] = (
+            clean_normalized,
+            name,
+            input_features[name],
+            normalize_cases,
+            locations_df,
+            universe_states,
+        )
 
     impute_group_2 = [
         "Apple_DrivingMobility.rolling(7).mean()",
@@ -414,15 +443,11 @@ def clean_features(env, input_features):
     ]
 
     for name in impute_group_2:
-        logger.info(f"Processing {name}.")
-        dm_national = select_universe(
-            input_features[name], universe_national, fill_missing=True
+        tasks[name] = (
+            clean_hierarchy,
+            name,
+            input_features[name],
+            universe_states,
+            universe_national,
         )
-        dm = select_universe(input_features[name], universe_states, fill_missing=True)
-        dm = dm.fillna(method="ffill")
-        dm = dm.fillna(get_national_value(dm, dm_national))
-        dm = dm.fillna(cross_section_mean(dm))
-        dm = cross_section_winsor(dm, 5)
-        output_features[name] = dm
-
-    return output_features
+    return run_tasks(tasks, env.n_jobs)
@@ -7,6 +7,7 @@ as input and return a transformed data matrix.
 import numpy as np
 import pandas as pd
 from onequietnight.data.utils import rename_columns_df, to_dataframe, to_matrix
+from scipy import sparse
 
 
 def normalize_beds(dm, locations_df):
@@ -90,52 +91,199 @@ def cross_section_winsor(dm, threshold=3):
     return dm.clip(lower, upper, axis=0)
 
 
+class Membership:
+    """Sparse (locations x groups) membership of the locations `ids`.
+
+    ids: location ids in the column order of the data matrices it is used
+        with. Functions taking a Membership check that the columns match.
+    groups: group label of each id. Locations with a missing label (NaN) do
+        not belong to any group.
+
+    matrix: csr matrix with a 1 for each location and its group.
+    codes: group of each location, or -1 for locations without a group.
+    """
+
+    def __init__(self, ids, groups):
+        self.ids = pd.Index(ids)
+        self.codes, uniques = pd.factorize(pd.Series(groups, index=ids))
+        rows = np.flatnonzero(self.codes >= 0)
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, self.codes[rows])),
+            shape=(len(self.codes), len(uniques)),
+        )
+
+    def check_columns(self, columns):
+        assert columns.equals(
+            self.ids
+        ), "Columns must be the locations of the membership, in the same order."
+
+
+def cbsa_membership(ids, locations_df):
+    """Return the county to CBSA membership matrix."""
+    cbsa = locations_df.set_index("id")["CBSA"].reindex(ids)
+    return Membership(ids, cbsa.values)
+
+
+def state_membership(ids):
+    """Return the county to state membership matrix."""
+    return Membership(ids, [s.split("_")[1] for s in ids])
+
+
+def national_membership(ids):
+    """Return the membership matrix of a single group holding every location."""
+    return Membership(ids, np.zeros(len(ids)))
+
+
+def group_means(values, membership):
+    """Return the NaN-aware (dates x groups) means of a (dates x locations) array."""
+    observed = ~np.isnan(values)
+    sums = np.where(observed, values, 0) @ membership.matrix
+    counts = observed.astype(float) @ membership.matrix
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return sums / counts
+
+
+def gather_columns(values, index):
+    """Return `values[:, index]` where an index of -1 selects NaN."""
+    values = np.concatenate([values, np.full((len(values), 1), np.nan)], axis=1)
+    return values[:, index]
+
+
+def cross_section_group_mean(dm, membership):
+    """Compute the mean within groups and broadcast it back to the members.
+
+    NaNs are ignored. Locations without a group and groups without any
+    observation on a date get NaN.
+    """
+    membership.check_columns(dm.columns)
+    means = group_means(dm.values, membership)
+    out = gather_columns(means, membership.codes)
+    return pd.DataFrame(out, index=dm.index, columns=dm.columns)
+
+
 def cross_section_mean(dm):
     """Compute mean across all counties."""
-    df = to_dataframe(dm)
-    df = df.groupby("dates")["value"].transform(np.nanmean)
-    return to_matrix(df)
+    return cross_section_group_mean(dm, national_membership(dm.columns))
 
 
-def cross_section_cbsa_mean(dm, locations_df):
+def cross_section_cbsa_mean(dm, locations_df, membership=None):
     """Compute mean within CBSA.
 
-    Group counties without membership as a group using groupby(dropna=False).
+    Counties without CBSA membership get NaN. Pass a precomputed `membership`
+    from `cbsa_membership(dm.columns, locations_df)` when calling this
+    repeatedly on the same universe.
     """
-    df = to_dataframe(dm)
-    df = df.reset_index("dates").join(locations_df.set_index("id")["CBSA"])
-    df = df.set_index("dates", append=True)
-    df = df.groupby(["dates", "CBSA"], dropna=True)["value"].transform(np.nanmean)
-    return to_matrix(df)
+    if membership is None:
+        membership = cbsa_membership(dm.columns, locations_df)
+    return cross_section_group_mean(dm, membership)
 
 
-def cross_section_state_mean(dm):
-    """Compute mean within state level."""
-    df = to_dataframe(dm)
-    df = df.reset_index("id")
-    df["state"] = df["id"].apply(lambda s: s.split("_")[1])
-    df = df.set_index("id", append=True)
-    df = df.groupby(["dates", "state"])["value"].transform(np.mean)
-    return to_matrix(df)
+def cross_section_state_mean(dm, membership=None):
+    """Compute mean within state level.
+
+    Pass a precomputed `membership` from `state_membership(dm.columns)` when
+    calling this repeatedly on the same universe.
+    """
+    if membership is None:
+        membership = state_membership(dm.columns)
+    return cross_section_group_mean(dm, membership)
 
 
-def get_state_value(dm, dm_state):
-    df = to_dataframe(dm)
-    df = df.reset_index("id")
-    df["state"] = df["id"].apply(lambda s: "_".join(s.split("_")[1:]))
-    df = df.set_index("id", append=True)
-    df = df.join(to_dataframe(dm_state), on=["dates", "state"], rsuffix="_state")
-    return to_matrix(df["value_state"])
+def state_ids(ids):
+    """Return the state id of each county id.
+
+    For example, 'King_Washington_UnitedStates' -> 'Washington_UnitedStates'.
+    """
+    return np.array(["_".join(s.split("_")[1:]) for s in ids], dtype=object)
+
+
+def gather_parent_value(dm, dm_parent, index):
+    """Broadcast parent values onto their children with a single gather.
+
+    index: position of each column of `dm` in `dm_parent.columns`, or -1 for
+        columns without a parent (these get NaN).
+    """
+    values = gather_columns(dm_parent.reindex(dm.index).values, index)
+    return pd.DataFrame(values, index=dm.index, columns=dm.columns)
+
+
+def get_state_value(dm, dm_state, parents=None):
+    """Return the value of the state of each county.
+
+    Pass precomputed `parents` from `state_ids(dm.columns)` when calling this
+    repeatedly on the same universe.
+    """
+    if parents is None:
+        parents = state_ids(dm.columns)
+    return gather_parent_value(dm, dm_state, dm_state.columns.get_indexer(parents))
 
 
 def get_national_value(dm, dm_national):
     if dm_national.empty:
         return dm.assign(value=np.nan)
-    df = to_dataframe(dm)
-    df = pd.merge(
-        df.reset_index(),
-        to_dataframe(dm_national).reset_index(),
-        on=["dates"],
-        suffixes=("", "_national"),
+    return gather_parent_value(dm, dm_national, np.zeros(dm.shape[1], dtype=int))
+
+
+def fillna_gather(out, values, index):
+    """Fill the NaNs of `out` in place from `gather_columns(values, index)`.
+
+    Only the missing cells are gathered, so the broadcast matrix is never
+    materialized.
+    """
+    rows, cols = np.nonzero(np.isnan(out))
+    parents = index[cols]
+    has_parent = parents >= 0
+    rows, cols, parents = rows[has_parent], cols[has_parent], parents[has_parent]
+    out[rows, cols] = values[rows, parents]
+
+
+def impute_hierarchy(dm, dm_state, cbsa, state, parents, threshold=5):
+    """Impute county values through the location hierarchy in one pass.
+
+    This is equivalent to (and bit-identical with) the cascade
+
+        dm = dm.fillna(method="ffill")
+        dm = dm.fillna(cross_section_cbsa_mean(dm, locations_df, cbsa))
+        dm = dm.fillna(get_state_value(dm, dm_state, parents))
+        dm = dm.fillna(cross_section_state_mean(dm, state))
+        dm = dm.fillna(cross_section_mean(dm))
+        dm = cross_section_winsor(dm, threshold)
+
+    but fills and clips a single output array in place instead of allocating
+    a new frame and a broadcast group mean at every step.
+
+    cbsa, state: memberships of `dm.columns`.
+    parents: state id of each column of `dm`, see `state_ids`.
+    """
+    # Work on (locations x dates) arrays so the output has the memory layout
+    # of the frames built by the cascade; the winsor statistics below are
+    # reductions whose rounding depends on it.
+    cbsa.check_columns(dm.columns)
+    state.check_columns(dm.columns)
+    values = dm.values.T
+    n_locations, n_dates = values.shape
+
+    # Forward fill: gather each cell from the last observed date of its column.
+    last = np.tile(np.arange(n_dates), (n_locations, 1))
+    last[np.isnan(values)] = 0
+    np.maximum.accumulate(last, axis=1, out=last)
+    out = values[np.arange(n_locations)[:, None], last].T
+
+    fillna_gather(out, group_means(out, cbsa), cbsa.codes)
+    fillna_gather(
+        out,
+        dm_state.reindex(dm.index).values,
+        dm_state.columns.get_indexer(parents),
     )
-    return to_matrix(df.set_index(["dates", "id"])["value_national"])
+    fillna_gather(out, group_means(out, state), state.codes)
+    national = national_membership(dm.columns)
+    fillna_gather(out, group_means(out, national), national.codes)
+
+    # Cross sectional winsorization, see `cross_section_winsor`.
+    frame = pd.DataFrame(out, index=dm.index, columns=dm.columns)
+    location = frame.mean(1)
+    spread = frame.std(1)
+    lower = (location - threshold * spread).values[:, None]
+    upper = (location + threshold * spread).values[:, None]
+    np.clip(out, lower, upper, out=out)
+    return pd.DataFrame(out, index=dm.index, columns=dm.columns)
@@ -5,53 +5,82 @@ a training data set using historical data of features and targets, retrains
 a model, and makes predictions using the latest instance of the feature values.
 """
 import json
+import shutil
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+from onequietnight import dag
+from onequietnight.data.io import atomic_path
 from onequietnight.env import OneQuietNightEnvironment
 
 
-def main():
-    """Retrain the model and generate real-time predictions."""
+def main(targets=None):
+    """Retrain the model and generate real-time predictions.
+
+    targets: optional names of the stages to run, with the stages they
+        depend on, e.g. ["models:county"]. See onequietnight.dag.
+    """
     env = OneQuietNightEnvironment(Path.cwd())
-    env.get_data()
-    env.get_features()
-    env.train_models()
-    env.save_visualization_data()
-    env.save_covidhub_data()
+    dag.run(env, targets)
+
+
+def append_forecasts(filepath_actuals, df_preds):
+    """Append the rows of `df_preds` past the last date of the actuals CSV.
+
+    Only the dates column of the actuals is read, and rows appended by an
+    earlier run are not appended again. Return the number of rows appended.
+    """
+    columns = pd.read_csv(filepath_actuals, nrows=0).columns
+    last_date = pd.read_csv(filepath_actuals, usecols=["dates"])["dates"].values[-1]
+    df_new = df_preds[df_preds["dates"] > last_date].reindex(columns=columns)
+    if len(df_new):
+        with atomic_path(filepath_actuals) as temp_path:
+            shutil.copyfile(str(filepath_actuals), str(temp_path))
+            df_new.to_csv(temp_path, mode="a", header=False, index=False)
+    return len(df_new)
 
 
 def validate_viz():
+    # Location of the end value reported in config.json for each universe.
+    end_value_locations = {"County": "53033", "State": "53"}
+    end_values = {}
     for universe_name in ["County", "State", "Country"]:
         filename_actuals = f"JHU_IncidentCases_{universe_name}.csv"
         filepath_actuals = Path(Path.cwd(), "vis", "src", "Data", universe_name, filename_actuals)
-        df_actuals = pd.read_csv(filepath_actuals)
 
         filename_preds = f"OQN_IncidentCasesForecast_{universe_name}.csv"
         filepath_preds = Path(Path.cwd(), "vis", "src", "Data", universe_name, filename_preds)
-        df_preds = pd.read_csv(filepath_preds)
-
-        dataEndDate = df_actuals["dates"].values[-1]
-        if universe_name == "County":
-            dataKingCountyEndValue = int(df_actuals["53033"].values[-1])
-        elif universe_name == "State":
-            dataWashingtonStateEndValue = int(df_actuals["53"].values[-1])
+        df_preds = pd.read_csv(filepath_preds, dtype={"dates": str})
         forecastStartDate = df_preds["dates"].values[0]
         forecastEndDate = df_preds["dates"].values[-1]
 
-        df = pd.concat([df_actuals, df_preds])
-        df.to_csv(filepath_actuals, index=False)
+        # The actuals CSV may already contain the forecasts of an earlier run,
+        # so the data ends at the last date before the forecasts start.
+        location = end_value_locations.get(universe_name)
+        df_actuals = pd.read_csv(
+            filepath_actuals,
+            usecols=["dates"] + ([location] if location else []),
+            dtype={"dates": str},
+        )
+        end = np.searchsorted(df_actuals["dates"].values, forecastStartDate) - 1
+        dataEndDate = df_actuals["dates"].values[end]
+        if location:
+            end_values[universe_name] = int(df_actuals[location].values[end])
+
+        append_forecasts(filepath_actuals, df_preds)
     config = dict(
         dataEndDate=dataEndDate,
-        dataKingCountyEndValue=dataKingCountyEndValue,
-        dataWashingtonStateEndValue=dataWashingtonStateEndValue,
+        dataKingCountyEndValue=end_values["County"],
+        dataWashingtonStateEndValue=end_values["State"],
         forecastStartDate=forecastStartDate,
         forecastEndDate=forecastEndDate,
     )
     print(config)
-    with open(Path(Path.cwd(), "vis", "src", "config.json"), "w") as f:
-        json.dump(config, f)
+    with atomic_path(Path(Path.cwd(), "vis", "src", "config.json")) as temp_path:
+        with open(temp_path, "w") as f:
+            json.dump(config, f)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+"""Rolling-origin backtests of the forecast pipelines over instance offsets.
+
+A backtest fits and predicts every (universe, horizon) pipeline as of each
+instance_offset, the number of weeks before the latest instance. All offsets
+share the environment's features and design matrices, and the forecasts are
+streamed into a single parquet file with an instance_offset column.
+"""
+
+import logging
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from onequietnight.config import max_weeks_ahead, model_configs
+from onequietnight.data.io import get_date_partition
+from onequietnight.models.forecast import ForecastPipeline, fit_model
+from onequietnight.parallel import run_tasks
+
+logger = logging.getLogger(__name__)
+
+backtest_filename = "backtest.parquet"
+
+
+def fit_predict_model(model, X, y, instance_X):
+    """Fit `model` and return its (predictions, quantile predictions)."""
+    model = fit_model(model, X, y)
+    X = model.named_steps["scaler"].transform(instance_X)
+    return model.named_steps["model"].predict_all(X)
+
+
+def get_pipelines(env):
+    """Return a pipeline per universe and horizon, as in env.train_models."""
+    return {
+        (name, n_week_ahead): ForecastPipeline(
+            env, **config, **dict(n_week_ahead=n_week_ahead)
+        )
+        for name, config in model_configs.items()
+        for n_week_ahead in range(1, max_weeks_ahead + 1)
+    }
+
+
+def backtest_batch(env, pipelines, instance_offsets, should_undo_normalize_cases):
+    """Return the forecasts of all pipelines at each of `instance_offsets`."""
+    instance_dates = {}
+    tasks = {}
+    for instance_offset in instance_offsets:
+        for key, pipeline in pipelines.items():
+            X_train, y_train = pipeline.get_training_data(instance_offset)
+            instance_date, instance_X = pipeline.get_instance(
+                instance_offset=instance_offset
+            )
+            instance_dates[(instance_offset,) + key] = instance_date
+            tasks[(instance_offset,) + key] = (
+                fit_predict_model,
+                pipeline.get_model(),
+                X_train,
+                y_train,
+                instance_X,
+            )
+    forecast = []
+    for task_key, (predictions, predictions_proba) in run_tasks(
+        tasks, env.n_jobs, env.jax_threads
+    ).items():
+        instance_offset, *key = task_key
+        pipeline = pipelines[tuple(key)]
+        instance_date = instance_dates[task_key]
+        for forecast_df in [
+            pipeline.format_predict(
+                instance_date, predictions, should_undo_normalize_cases
+            ),
+            pipeline.format_predict_proba(
+                instance_date, predictions_proba, should_undo_normalize_cases
+            ),
+        ]:
+            forecast_df["instance_offset"] = instance_offset
+            forecast.append(forecast_df)
+    forecast_df = pd.concat(forecast, ignore_index=True)
+    forecast_df["forecast_date"] = forecast_df["forecast_date"].astype(str)
+    forecast_df["target_end_date"] = pd.to_datetime(forecast_df["target_end_date"])
+    forecast_df["quantile"] = forecast_df["quantile"].astype(float)
+    forecast_df["value"] = forecast_df["value"].astype(float)
+    return forecast_df
+
+
+def backtest(env, instance_offsets, path=None, should_undo_normalize_cases=False):
+    """Backtest all pipelines at each of `instance_offsets`, e.g. range(-30, 0).
+
+    The fits of env.n_jobs offsets at a time are run in parallel, and their
+    forecasts are appended to the parquet file at `path`, by default
+    backtest.parquet in today's partition. Return the path, or the forecasts
+    as a dataframe if there is nowhere to write them.
+    """
+    if path is None and env.write:
+        path = Path(get_date_partition(env), backtest_filename)
+    pipelines = get_pipelines(env)
+    instance_offsets = list(instance_offsets)
+    batch_size = max(env.n_jobs, 1)
+    writer = None
+    forecasts = []
+    for start in range(0, len(instance_offsets), batch_size):
+        batch = instance_offsets[start : start + batch_size]
+        logger.info(f"Backtesting instance offsets {batch}.")
+        forecast_df = backtest_batch(
+            env, pipelines, batch, should_undo_normalize_cases
+        )
+        if path is None:
+            forecasts.append(forecast_df)
+            continue
+        if writer is None:
+            table = pa.Table.from_pandas(forecast_df, preserve_index=False)
+            writer = pq.ParquetWriter(str(path), table.schema)
+        else:
+            table = pa.Table.from_pandas(
+                forecast_df, schema=writer.schema, preserve_index=False
+            )
+        writer.write_table(table)
+    if path is None:
+        return pd.concat(forecasts, ignore_index=True)
+    if writer is not None:
+        writer.close()
+        logger.info(f"Wrote backtest forecasts to {str(path)}.")
+    return path
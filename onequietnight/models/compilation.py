@@ -0,0 +1,99 @@
+"""Persistent XLA compilation cache and compile time accounting for JAX models.
+
+NUTS traces and compiles its kernel once per distinct input shape. With the
+persistent cache enabled, compiled executables are written to disk and later
+processes with the same shapes load them instead of compiling. Padding the
+training rows to bucketed sizes (see `bucket_rows`) keeps the shapes stable
+as the number of training rows changes from day to day.
+
+The persistent cache needs jax 0.2.12 or later, and the split of compile and
+run time needs jax.monitoring (jax 0.4). With the jax version pinned in
+setup.py, `enable_compilation_cache` only logs a warning and `compile_timer`
+only logs the total time.
+"""
+
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Seconds spent tracing, lowering and compiling in this process, when jax
+# reports them.
+compile_seconds = {"total": 0.0, "listening": False}
+
+
+def enable_compilation_cache(path):
+    """Cache compiled XLA executables under `path`.
+
+    The cache directory is also exported as JAX_COMPILATION_CACHE_DIR, so
+    worker processes started afterwards use the same cache.
+    """
+    os.environ["JAX_COMPILATION_CACHE_DIR"] = str(path)
+    import jax
+
+    try:
+        jax.config.update("jax_compilation_cache_dir", str(path))
+        jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+    except AttributeError:
+        try:
+            from jax.experimental.compilation_cache import compilation_cache
+
+            compilation_cache.initialize_cache(str(path))
+        except ImportError:
+            logger.warning("This version of jax has no persistent compilation cache.")
+            return
+    logger.info(f"Caching compiled models in {str(path)}.")
+
+
+def record_compile_time(event, duration, **kwargs):
+    if event.startswith("/jax/core/compile/"):
+        compile_seconds["total"] += duration
+
+
+def register_compile_listener():
+    """Accumulate compile times in `compile_seconds` if jax reports them."""
+    if not compile_seconds["listening"]:
+        try:
+            from jax import monitoring
+
+            monitoring.register_event_duration_secs_listener(record_compile_time)
+            compile_seconds["listening"] = True
+        except (ImportError, AttributeError):
+            pass
+    return compile_seconds["listening"]
+
+
+@contextmanager
+def compile_timer(name):
+    """Log the compile and run time of the block."""
+    has_listener = register_compile_listener()
+    compile_start = compile_seconds["total"]
+    start = time.monotonic()
+    yield
+    total = time.monotonic() - start
+    if has_listener:
+        compile_time = compile_seconds["total"] - compile_start
+        logger.info(
+            f"{name}: {compile_time:.1f}s compiling, {total - compile_time:.1f}s running."
+        )
+    else:
+        logger.info(f"{name}: {total:.1f}s.")
+
+
+def bucket_rows(num_rows, bucket_padding=None):
+    """Round `num_rows` up to a bucket size.
+
+    Bucket sizes keep the leading binary digits of `num_rows` needed for at
+    most a `bucket_padding` fraction of padding rows, e.g. with 0.25 the
+    sizes are 24, 28, 32, 40, 48, 56, 64, 80, ... Small training sets are
+    padded as little as large ones, relative to their size.
+    """
+    if not bucket_padding:
+        return num_rows
+    significant_bits = 1 + int(np.ceil(np.log2(1 / bucket_padding)))
+    step = 2 ** max(int(num_rows).bit_length() - significant_bits, 0)
+    return int(np.ceil(num_rows / step)) * step
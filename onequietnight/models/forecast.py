@@ -2,6 +2,7 @@ import logging
 
 import numpy as np
 import pandas as pd
+from onequietnight.config import max_weeks_ahead
 from onequietnight.data.utils import to_dataframe, to_matrix
 from onequietnight.features import model_names
 from onequietnight.features.transforms import (
@@ -26,95 +27,153 @@ class ForecastPipeline:
     ]
 
     def __init__(
-        self, env, universe=None, n_week_ahead=1, train_window=20, feature_columns=[]
+        self,
+        env,
+        universe=None,
+        n_week_ahead=1,
+        train_window=20,
+        feature_columns=[],
+        engine="nuts",
     ):
-        self.env = env
+        """
+        engine: "nuts" samples the posterior of ClippedModel with NUTS.
+            "sufficient_stats" samples the same posterior from sufficient
+            statistics, which is faster for large universes. "conjugate"
+            uses the closed-form ConjugateModel instead.
+        """
         self.universe = universe
         self.n_week_ahead = n_week_ahead
         self.train_window = train_window
         self.feature_columns = feature_columns
+        self.engine = engine
+        self.target_column = target_column(n_week_ahead)
+        self.set_env(env)
+
+    # Attributes derived from the environment. Pickled pipelines, e.g. in the
+    # model store, leave them out with the environment and its data and
+    # features; whoever loads them calls set_env.
+    env_attributes = [
+        "env",
+        "dates",
+        "design",
+        "data_columns",
+        "valid",
+        "feature_index",
+        "target_index",
+    ]
 
+    def set_env(self, env):
+        """Set the environment, and the design of the universe from its features."""
+        self.env = env
         self.dates = pd.date_range(
             env.start_date, env.today, freq="W-SAT", name="dates"
         )
-        self.df = self.get_data()
-
-    def get_features(self):
-        """Return the set of features in a dataframe indexed by id and dates."""
-        assert (
-            self.universe in model_names
-        ), f"Universe must be one of {str(model_names)}."
-        logger.info("Loading features.")
-        return pd.concat(
-            [
-                to_dataframe(dm, name)
-                for name, dm in self.env.features[self.universe].items()
-            ],
-            axis=1,
-            join="outer",
+        self.design = env.get_design(self.universe)
+        self.data_columns = [
+            column
+            for column in self.design.columns
+            if column not in target_columns() or column == self.target_column
+        ]
+        # Training rows must be present with all features and the target.
+        self.valid = self.design.valid(self.data_columns)
+        self.feature_index = self.design.column_index(self.feature_columns)
+        self.target_index = self.design.column_index([self.target_column])[0]
+
+    def __getstate__(self):
+        return {
+            name: value
+            for name, value in self.__dict__.items()
+            if name not in self.env_attributes
+        }
+
+    @property
+    def df(self):
+        """The features of the universe with the target of this horizon."""
+        return self.design.to_frame(self.data_columns).rename(
+            columns={self.target_column: "target"}
         )
 
-    def get_target(self):
-        """Compute new cases per 100k people per week shifted by t_shift."""
-        logger.info("Creating target.")
-        env = self.env
-        t_shift = self.n_week_ahead
-        all_dates = pd.date_range(env.start_date, env.today, name="dates")
-        dates = pd.date_range(env.start_date, env.today, freq="W-SAT", name="dates")
-        df = env.data["JHU_ConfirmedCases"].copy()
-        dm = to_matrix(df)
-        dm.index = pd.to_datetime(dm.index)
-        dm = dm.reindex(all_dates)
-        dm = dm.reindex(dates)
-        dm = dm.diff(1).clip(0)
-        dm = normalize_cases(dm, env.locations_df)
-        target = dm.shift(-t_shift)
-        target = to_dataframe(target, "target")
-        return target
-
-    def get_data(self):
-        features_df = self.get_features()
-        target = self.get_target()
-        return features_df.join(target, how="inner")
-
-    def get_model(self):
-        from onequietnight.models.models.bayesian import ClippedModel
+    def get_model(self, previous=None):
+        """Return an unfitted model.
+
+        previous: optional ForecastPipeline fitted on an earlier day. If it
+            has the same engine and features, the model is warm started from
+            its posterior.
+        """
+        from onequietnight.models.models.bayesian import (
+            ClippedModel,
+            ConjugateModel,
+            SufficientStatsModel,
+        )
         from sklearn.pipeline import Pipeline
         from sklearn.preprocessing import StandardScaler
 
-        return Pipeline([("scaler", StandardScaler()), ("model", ClippedModel())])
+        models = {
+            "nuts": ClippedModel,
+            "sufficient_stats": SufficientStatsModel,
+            "conjugate": ConjugateModel,
+        }
+        assert self.engine in models, f"Engine must be one of {str(list(models))}."
+        if self.engine == "nuts":
+            model = ClippedModel(bucket_padding=self.env.bucket_padding)
+        else:
+            model = models[self.engine]()
+        if (
+            previous is not None
+            and getattr(previous, "engine", "nuts") == self.engine
+            and previous.feature_columns == self.feature_columns
+            and hasattr(model, "warm_start_from")
+        ):
+            model.warm_start_from(previous.model.named_steps["model"])
+        return Pipeline([("scaler", StandardScaler()), ("model", model)])
 
-    def fit(self, instance_offset=0):
+    def get_training_data(self, instance_offset=0):
+        """Return the (X, y) training arrays of the window before the instance."""
         train_window = self.train_window
         dates = self.dates
-        feature_columns = self.feature_columns
         offset = self.n_week_ahead
         train_dates = dates[
             instance_offset - train_window - offset : instance_offset - offset
         ]
         logger.info(f"Training on window [{train_dates[0]}, {train_dates[-1]}]")
-        train = self.df.loc[train_dates]
-        train = train.replace([-np.inf, np.inf], np.nan)
-        train_missing_any_cols = train.isnull().any(1)
-        if train_missing_any_cols.any():
-            logger.info(f"Dropping missing values: {train_missing_any_cols[train_missing_any_cols].index}")
-            train = train.dropna()
-        y_train = train["target"].values
-        X_train = train[feature_columns].values
+        window = self.design.date_slice(train_dates[0], train_dates[-1])
+        valid = self.valid[window]
+        num_missing = np.sum(self.design.present[window] & ~valid)
+        if num_missing:
+            logger.info(f"Dropping {num_missing} rows with missing values.")
+        train = self.design.values[window][valid]
+        y_train = train[:, self.target_index]
+        X_train = train[:, self.feature_index]
         logger.info(f"X: {X_train.shape}, y: {y_train.shape}")
+        return X_train, y_train
+
+    def fit(self, instance_offset=0):
+        X_train, y_train = self.get_training_data(instance_offset)
         self.model = self.get_model()
         self.model.fit(X_train, y_train)
 
-    def predict(self, offset=0, instance_offset=0, should_undo_normalize_cases=False):
-        assert hasattr(self, "model")
+    def get_instance(self, offset=0, instance_offset=0):
+        """Return the instance date and the (X) array to predict on."""
         instance_date = self.dates[instance_offset - 1 - offset]
-        instance = self.df.loc[[instance_date]]
-        instance_X = instance[self.feature_columns].values
-
+        position, _ = self.design.instance(instance_date)
         logger.info(f"Predicting on {instance_date}.")
-        logger.debug(f"Instance {instance.head().to_markdown()}.")
+        instance = self.design.values[position][self.design.present[position]]
+        return instance_date, instance[:, self.feature_index]
+
+    def predict(self, offset=0, instance_offset=0, should_undo_normalize_cases=False):
+        assert hasattr(self, "model")
+        instance_date, instance_X = self.get_instance(offset, instance_offset)
         predictions = self.model.predict(instance_X)
-        predictions_df = pd.Series(predictions, index=instance.index)
+        return self.format_predict(
+            instance_date, predictions, should_undo_normalize_cases
+        )
+
+    def format_predict(
+        self, instance_date, predictions, should_undo_normalize_cases=False
+    ):
+        """Return point predictions of the instance in the covidhub format."""
+        _, index = self.design.instance(instance_date)
+        predictions_df = pd.Series(predictions, index=index)
         predictions_dm = to_matrix(predictions_df)
 
         if should_undo_normalize_cases:
@@ -137,15 +196,77 @@ class ForecastPipeline:
         self, offset=0, instance_offset=0, should_undo_normalize_cases=False
     ):
         assert hasattr(self, "model")
-        instance_date = self.dates[instance_offset - 1 - offset]
-        instance = self.df.loc[[instance_date]]
-        instance_X = instance[self.feature_columns].values
-
-        logger.info(f"Predicting on {instance_date}.")
-        logger.debug(f"Instance {instance.head().to_markdown()}.")
+        instance_date, instance_X = self.get_instance(offset, instance_offset)
         predictions = self.model.predict_proba(instance_X)
+        return self.format_predict_proba(
+            instance_date, predictions, should_undo_normalize_cases
+        )
+
+    def predict_scenarios(
+        self, scenarios, offset=0, instance_offset=0, should_undo_normalize_cases=False
+    ):
+        """Return forecasts of the instance under perturbations of its features.
+
+        scenarios: dict of scenario name to a dict of feature column to
+            (scale, shift), which replaces the column by
+            scale * column + shift. Scale and shift are numbers, or series
+            indexed by id where locations missing from the series are not
+            perturbed. An empty dict of perturbations gives a baseline
+            scenario to compare the others with. For example, scaling every
+            Apple mobility column by 1.2:
+
+                {"mobility_up": {column: (1.2, 0) for column in apple_columns}}
+
+        All scenarios are evaluated in one pass against the posterior of the
+        fitted model; see predict_scenarios of the models. NUTS models draw
+        the scenarios with their own noise, shared by all scenarios, so the
+        baseline matches `predict` only up to Monte Carlo noise.
+
+        Return the point and quantile forecasts in the covidhub format with a
+        scenario column.
+        """
+        assert hasattr(self, "model")
+        assert scenarios, "There must be at least one scenario."
+        instance_date, instance_X = self.get_instance(offset, instance_offset)
+        _, index = self.design.instance(instance_date)
+        ids = index.get_level_values("id")
+        Xs = np.repeat(instance_X[None], len(scenarios), axis=0)
+        for i, perturbations in enumerate(scenarios.values()):
+            for column, (scale, shift) in perturbations.items():
+                k = self.feature_columns.index(column)
+                Xs[i, :, k] = Xs[i, :, k] * get_location_values(
+                    scale, ids, 1
+                ) + get_location_values(shift, ids, 0)
+        Xs = (
+            self.model.named_steps["scaler"]
+            .transform(Xs.reshape(-1, Xs.shape[2]))
+            .reshape(Xs.shape)
+        )
+        predictions, predictions_proba = self.model.named_steps[
+            "model"
+        ].predict_scenarios(Xs)
+
+        forecast = []
+        for i, name in enumerate(scenarios):
+            for forecast_df in [
+                self.format_predict(
+                    instance_date, predictions[i], should_undo_normalize_cases
+                ),
+                self.format_predict_proba(
+                    instance_date, predictions_proba[i], should_undo_normalize_cases
+                ),
+            ]:
+                forecast_df["scenario"] = name
+                forecast.append(forecast_df)
+        return pd.concat(forecast, ignore_index=True)
+
+    def format_predict_proba(
+        self, instance_date, predictions, should_undo_normalize_cases=False
+    ):
+        """Return quantile predictions of the instance in the covidhub format."""
+        _, index = self.design.instance(instance_date)
         predictions_df = pd.DataFrame(predictions)
-        predictions_df.index = instance.index
+        predictions_df.index = index
 
         predictions_df = predictions_df.stack()
         predictions_df.index = predictions_df.index.set_names("quantile", -1)
@@ -163,3 +284,149 @@ class ForecastPipeline:
             self.n_week_ahead, weekday=5
         )
         return predictions_df[self.predict_cols]
+
+
+def get_location_values(value, ids, default):
+    """Return a number, or a series indexed by id aligned to `ids`."""
+    if isinstance(value, pd.Series):
+        return value.reindex(ids).fillna(default).values
+    return value
+
+
+def target_column(n_week_ahead):
+    return f"target_{n_week_ahead}"
+
+
+def target_columns():
+    return [target_column(n) for n in range(1, max_weeks_ahead + 1)]
+
+
+def get_features(env, universe):
+    """Return the set of features in a dataframe indexed by id and dates."""
+    assert universe in model_names, f"Universe must be one of {str(model_names)}."
+    logger.info("Loading features.")
+    return pd.concat(
+        [to_dataframe(dm, name) for name, dm in env.features[universe].items()],
+        axis=1,
+        join="outer",
+    )
+
+
+def get_targets(env):
+    """Compute new cases per 100k people per week shifted by each horizon."""
+    logger.info("Creating targets.")
+    all_dates = pd.date_range(env.start_date, env.today, name="dates")
+    dates = pd.date_range(env.start_date, env.today, freq="W-SAT", name="dates")
+    df = env.data["JHU_ConfirmedCases"].copy()
+    dm = to_matrix(df)
+    dm.index = pd.to_datetime(dm.index)
+    dm = dm.reindex(all_dates)
+    dm = dm.reindex(dates)
+    dm = dm.diff(1).clip(0)
+    dm = normalize_cases(dm, env.locations_df)
+    return pd.concat(
+        [
+            to_dataframe(dm.shift(-n_week_ahead), target_column(n_week_ahead))
+            for n_week_ahead in range(1, max_weeks_ahead + 1)
+        ],
+        axis=1,
+    )
+
+
+class Design:
+    """Features and targets of a universe as a dates x locations x columns array.
+
+    values[i, j, k] is column k of location ids[j] on dates[i]. (date, id)
+    pairs missing from the source frame are NaN and False in `present`.
+    Training windows and instances are slices along the first axis.
+    """
+
+    def __init__(self, df):
+        # Locations keep their order in the frame, so that rows come out of
+        # the array in the same order as out of the frame.
+        self.dates = df.index.get_level_values("dates").unique().sort_values()
+        self.ids = df.index.get_level_values("id").unique()
+        self.columns = list(df.columns)
+        date_index = self.dates.get_indexer(df.index.get_level_values("dates"))
+        id_index = self.ids.get_indexer(df.index.get_level_values("id"))
+        shape = (len(self.dates), len(self.ids))
+        self.values = np.full(shape + (len(self.columns),), np.nan)
+        self.values[date_index, id_index] = df.values
+        self.present = np.zeros(shape, dtype=bool)
+        self.present[date_index, id_index] = True
+
+    def column_index(self, columns):
+        return [self.columns.index(column) for column in columns]
+
+    def valid(self, columns):
+        """Return the (dates, ids) mask of present rows with finite `columns`."""
+        finite = np.isfinite(self.values[:, :, self.column_index(columns)])
+        return self.present & finite.all(axis=2)
+
+    def date_slice(self, start, end):
+        """Return the slice of the dates in [start, end]."""
+        return slice(
+            self.dates.searchsorted(start), self.dates.searchsorted(end, side="right")
+        )
+
+    def instance(self, date):
+        """Return the (position, index) of the rows of `date`."""
+        position = self.dates.get_loc(date)
+        index = pd.MultiIndex.from_product(
+            [[date], self.ids[self.present[position]]], names=["dates", "id"]
+        )
+        return position, index
+
+    def to_frame(self, columns):
+        """Return `columns` as a dataframe indexed by dates and id."""
+        date_index, id_index = np.nonzero(self.present)
+        index = pd.MultiIndex.from_arrays(
+            [self.dates[date_index], self.ids[id_index]], names=["dates", "id"]
+        )
+        values = self.values[date_index, id_index][:, self.column_index(columns)]
+        return pd.DataFrame(values, index=index, columns=columns)
+
+
+def get_design(env, universe):
+    """Return the features of `universe` and the target of each horizon.
+
+    The pipelines of all horizons share this Design; the target of horizon
+    n is the column target_column(n).
+    """
+    return Design(get_features(env, universe).join(get_targets(env), how="inner"))
+
+
+def fit_model(model, X, y):
+    """Fit and return `model`. Runs in worker processes, without the environment."""
+    return model.fit(X, y)
+
+
+def predict_model(model, X, should_predict_proba=False):
+    """Return (predictions, quantile predictions or None) of a fitted `model`."""
+    if should_predict_proba:
+        X = model.named_steps["scaler"].transform(X)
+        return model.named_steps["model"].predict_all(X)
+    return model.predict(X), None
+
+
+def fit_batched(pipelines, instance_offset=0):
+    """Fit NUTS pipelines that share feature columns in a single program.
+
+    This traces, compiles and warms up one sampler for all pipelines, for
+    example all horizons of a universe, instead of one per pipeline. Each
+    pipeline ends up with its own fitted model, as with ForecastPipeline.fit.
+    """
+    from onequietnight.models.models.bayesian import BatchedModel
+
+    assert all(pipeline.engine == "nuts" for pipeline in pipelines)
+    Xs, ys = [], []
+    for pipeline in pipelines:
+        X_train, y_train = pipeline.get_training_data(instance_offset)
+        pipeline.model = pipeline.get_model()
+        Xs.append(pipeline.model.named_steps["scaler"].fit_transform(X_train))
+        ys.append(y_train)
+    batched = BatchedModel(bucket_padding=pipelines[0].env.bucket_padding).fit(
+        Xs, ys
+    )
+    for pipeline, samples in zip(pipelines, batched.unstack_samples()):
+        pipeline.model.named_steps["model"].set_samples(samples)
@@ -0,0 +1,101 @@
+"""Content-addressed store of fitted models shared across date partitions.
+
+A fitted model is determined by the pipeline configuration, the model class,
+parameters and settings, the warm start state if any, and the training arrays. Their fingerprint keys the fitted
+model in base_path/model_index, so a later run with the same training data,
+for example a rerun before JHU has updated, reuses the stored posterior
+instead of sampling it again.
+"""
+
+import hashlib
+import logging
+from pathlib import Path
+
+import joblib
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+model_index_dirname = "model_index"
+
+
+def get_fingerprint(pipeline, model, X, y):
+    """Return the sha256 hex digest of a pipeline's fit inputs.
+
+    Warm started models are fitted from the posterior of a previous model,
+    so its warm start state is part of the inputs.
+    """
+    config = dict(
+        universe=pipeline.universe,
+        n_week_ahead=pipeline.n_week_ahead,
+        train_window=pipeline.train_window,
+        feature_columns=pipeline.feature_columns,
+        engine=pipeline.engine,
+        steps=[
+            (
+                name,
+                type(step).__module__,
+                type(step).__name__,
+                step.get_params(),
+                {
+                    setting: getattr(step, setting)
+                    for setting in getattr(step, "settings", [])
+                },
+            )
+            for name, step in model.steps
+        ],
+    )
+    digest = hashlib.sha256(repr(sorted(config.items())).encode())
+    for values in [X, y]:
+        update_digest(digest, values)
+    for name, step in model.steps:
+        warm_start = getattr(step, "warm_start_", None)
+        if warm_start is not None:
+            digest.update(f"{name} warm start".encode())
+            update_digest(digest, warm_start)
+    return digest.hexdigest()
+
+
+def get_instance_fingerprint(instance_date, instance_X):
+    """Return the sha256 hex digest of the instance a model predicts on."""
+    digest = hashlib.sha256(str(instance_date).encode())
+    update_digest(digest, instance_X)
+    return digest.hexdigest()
+
+
+def update_digest(digest, values):
+    """Update `digest` with arrays, or dicts, lists and tuples of arrays."""
+    if isinstance(values, dict):
+        for key, value in sorted(values.items(), key=lambda item: repr(item[0])):
+            digest.update(repr(key).encode())
+            update_digest(digest, value)
+    elif isinstance(values, (list, tuple)):
+        for value in values:
+            update_digest(digest, value)
+    else:
+        values = np.ascontiguousarray(values, dtype=float)
+        digest.update(repr(values.shape).encode())
+        digest.update(values.tobytes())
+
+
+def get_model_path(env, fingerprint):
+    return Path(env.base_path, model_index_dirname, f"{fingerprint}.joblib")
+
+
+def read_model(env, fingerprint):
+    """Return the fitted model with `fingerprint`, or None if there is none."""
+    if not env.write:
+        return None
+    path = get_model_path(env, fingerprint)
+    if not path.exists():
+        return None
+    logger.info(f"Reusing the model in {str(path)}.")
+    return joblib.load(str(path))
+
+
+def write_model(env, fingerprint, model):
+    if not env.write:
+        return
+    path = get_model_path(env, fingerprint)
+    Path.mkdir(path.parent, exist_ok=True)
+    joblib.dump(model, str(path))
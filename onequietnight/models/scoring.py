@@ -0,0 +1,113 @@
+"""Score forecasts against the weekly JHU truth.
+
+Forecasts are long dataframes in the format of env.predict and of
+backtests: one row per (target, target_end_date, id, quantile) and one
+"point" row per (target, target_end_date, id). The quantiles of each
+forecast are gathered into a (forecasts x quantile levels) array and all
+scores are computed as array operations over it:
+
+    wis: the weighted interval score of Bracher et al. (2021),
+        (|y - median| / 2 + sum_k alpha_k / 2 * IS_alpha_k(y)) / (K + 1 / 2)
+        over the K central (1 - alpha_k) intervals.
+    coverage_p: whether the central p interval contains the truth.
+    abs_error: absolute error of the point forecast.
+
+The truth is new cases per 100k people per week, so forecasts should be made
+with should_undo_normalize_cases=False.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Columns of the forecasts that identify a forecast.
+key_columns = ["instance_offset", "forecast_date", "target", "target_end_date", "id"]
+
+
+def gather_forecasts(forecasts_df):
+    """Return (keys, levels, quantiles, points) of long forecasts.
+
+    keys: dataframe of the distinct forecasts.
+    levels: sorted quantile levels, rounded to 6 decimals.
+    quantiles: array of shape (forecasts, levels), NaN where missing.
+    points: array of point forecasts of shape (forecasts,).
+    """
+    columns = [column for column in key_columns if column in forecasts_df]
+    # Groups are numbered in order of appearance, like drop_duplicates.
+    codes = forecasts_df.groupby(columns, sort=False).ngroup().values
+    keys = forecasts_df[columns].drop_duplicates().reset_index(drop=True)
+    is_point = (forecasts_df["type"] == "point").values
+    values = forecasts_df["value"].values.astype(float)
+
+    points = np.full(len(keys), np.nan)
+    points[codes[is_point]] = values[is_point]
+
+    level = np.round(forecasts_df["quantile"].values[~is_point].astype(float), 6)
+    levels, level_codes = np.unique(level, return_inverse=True)
+    quantiles = np.full((len(keys), len(levels)), np.nan)
+    quantiles[codes[~is_point], level_codes] = values[~is_point]
+    return keys, levels, quantiles, points
+
+
+def get_truth(truth_dm, dates, locations):
+    """Return truth_dm at each (date, location), NaN where it is missing."""
+    date_index = truth_dm.index.get_indexer(pd.to_datetime(dates))
+    location_index = truth_dm.columns.get_indexer(locations)
+    found = (date_index >= 0) & (location_index >= 0)
+    truth = np.full(len(found), np.nan)
+    truth[found] = truth_dm.values[date_index[found], location_index[found]]
+    return truth
+
+
+def interval_score(lower, upper, y, alpha):
+    return (
+        (upper - lower)
+        + 2 / alpha * np.clip(lower - y, 0, None)
+        + 2 / alpha * np.clip(y - upper, 0, None)
+    )
+
+
+def score_forecasts(env, forecasts, truth_dm=None):
+    """Return the scores of `forecasts` against the JHU truth.
+
+    forecasts: dataframe of forecasts or dict of them, as returned by
+        env.predict(should_predict_proba=True).
+    truth_dm: optional dates x location matrix of the truth, by default
+        env.get_new_cases_per_100k().
+
+    Return a dataframe with the forecast keys, the truth, wis, abs_error and
+    a coverage column per central interval. Forecasts without truth yet are
+    NaN.
+    """
+    if isinstance(forecasts, dict):
+        forecasts = pd.concat(forecasts.values())
+    if truth_dm is None:
+        truth_dm = env.get_new_cases_per_100k()
+    keys, levels, quantiles, points = gather_forecasts(forecasts)
+
+    location = env.locations_df.set_index("id")["location"]
+    y = get_truth(
+        truth_dm, keys["target_end_date"].values, location.reindex(keys["id"]).values
+    )
+
+    scores = keys.assign(truth=y)
+    scores["abs_error"] = np.abs(points - y)
+
+    lower_levels = levels[levels < 0.5]
+    upper_index = np.searchsorted(levels, np.round(1 - lower_levels, 6))
+    assert np.allclose(
+        levels[upper_index], 1 - lower_levels
+    ), "Quantile levels must be symmetric."
+    alphas = 2 * lower_levels
+    lower = quantiles[:, : len(lower_levels)]
+    upper = quantiles[:, upper_index]
+    median = quantiles[:, np.searchsorted(levels, 0.5)]
+
+    weighted = alphas / 2 * interval_score(lower, upper, y[:, None], alphas)
+    scores["wis"] = (np.abs(y - median) / 2 + weighted.sum(axis=1)) / (
+        len(alphas) + 0.5
+    )
+    covered = (lower <= y[:, None]) & (y[:, None] <= upper)
+    covered = np.where(np.isnan(y)[:, None] | np.isnan(lower), np.nan, covered)
+    for alpha, column in zip(alphas, covered.T):
+        scores[f"coverage_{1 - alpha:g}"] = column
+    return scores
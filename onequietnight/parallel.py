@@ -0,0 +1,53 @@
+"""Run independent tasks in-process or in a pool of worker processes."""
+
+import os
+
+from joblib import Parallel, delayed
+from joblib._parallel_backends import LokyBackend
+
+
+class ThreadLimitedLokyBackend(LokyBackend):
+    """Loky backend whose workers start with their thread pools limited.
+
+    The thread limit of each worker is set in the environment the worker
+    process starts with, before it unpickles a task, since unpickling a
+    fitted model already imports jax and XLA reads its flags on import.
+    OpenMP, MKL and OpenBLAS are limited to inner_max_num_threads threads.
+    XLA has no flag for the size of its thread pool; with one thread its
+    Eigen operations run single-threaded.
+
+    Loky only reuses workers started with the same environment, so workers
+    of an earlier pool without the limit are replaced.
+    """
+
+    def _prepare_worker_env(self, n_jobs):
+        env = super()._prepare_worker_env(n_jobs)
+        if self.inner_max_num_threads == 1:
+            env["XLA_FLAGS"] = " ".join(
+                [os.environ.get("XLA_FLAGS", ""), "--xla_cpu_multi_thread_eigen=false"]
+            ).strip()
+        return env
+
+
+def run_tasks(tasks, n_jobs=1, num_threads=None):
+    """Run tasks and return their results.
+
+    tasks: dict of key -> (func, *args). Each task computes func(*args).
+    n_jobs: number of worker processes. Tasks run in-process when n_jobs is 1.
+    num_threads: optional limit on the threads of each worker process, see
+        ThreadLimitedLokyBackend. Does not apply when tasks run in-process.
+
+    Numpy arrays in the arguments, including the blocks of DataFrames, are
+    shared with the workers as memory-mapped files instead of being pickled.
+    Results are returned as a dict in the order of `tasks`, so the output
+    does not depend on which worker finishes first.
+    """
+    if n_jobs == 1:
+        return {key: func(*args) for key, (func, *args) in tasks.items()}
+    backend = "loky"
+    if num_threads is not None:
+        backend = ThreadLimitedLokyBackend(inner_max_num_threads=num_threads)
+    results = Parallel(n_jobs=n_jobs, backend=backend, mmap_mode="c")(
+        delayed(func)(*args) for func, *args in tasks.values()
+    )
+    return dict(zip(tasks, results))
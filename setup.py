@@ -34,6 +34,7 @@ setup(
     install_requires=[
         "pandas==1.1.4",
         "numpy==1.18.4",
+        "scipy",
         "numpyro==0.4.1",
         "jax==0.2.3",
         "requests==2.23.0",
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+from onequietnight.data import apple, covidcast, covidtracking, google, jhu
+from onequietnight.env import OneQuietNightEnvironment
+from onequietnight.models.models.bayesian import LinearModel
+
+today = "2020-09-25"
+
+
+def make_locations(num_states=3, counties_per_state=4):
+    rng = np.random.default_rng(0)
+    states = [f"S{i}_UnitedStates" for i in range(num_states)]
+    counties = [
+        f"C{j}_{state}" for state in states for j in range(counties_per_state)
+    ]
+    ids = counties + states + ["UnitedStates"]
+    return pd.DataFrame(
+        {
+            "id": ids,
+            "population": rng.integers(1000, 100000, len(ids)).astype(float),
+            "hospitalLicensedBeds": rng.integers(10, 1000, len(ids)).astype(float),
+            "CBSA": [f"cbsa{i % 2}" for i in range(len(ids))],
+            "locationType": ["county"] * len(counties)
+            + ["state"] * len(states)
+            + ["country"],
+            "location": [str(i) for i in range(len(ids))],
+            "fips.id": [str(i) for i in range(len(ids))],
+        }
+    )
+
+
+def make_data(locations_df):
+    """Random walks of every metric of the data sources, with missing values."""
+    rng = np.random.default_rng(1)
+    dates = pd.date_range("2020-01-20", today, name="dates")
+    ids = pd.Index(locations_df["id"], name="id")
+    data = {}
+    for source in [jhu, apple, google, covidtracking, covidcast]:
+        for name in source.metrics:
+            values = np.cumsum(rng.normal(size=(len(dates), len(ids))), 0) + 100
+            values[rng.random(values.shape) < 0.1] = np.nan
+            dm = pd.DataFrame(values, index=dates, columns=ids)
+            data[name] = dm.stack(dropna=False).reset_index(name=name)
+    return data
+
+
+def get_forecasts(base_path, n_jobs):
+    locations_df = make_locations()
+    base_path.mkdir()
+    locations_df.to_feather(base_path / OneQuietNightEnvironment.locations_filename)
+    env = OneQuietNightEnvironment(base_path, today)
+    env.n_jobs = n_jobs
+    env.data = make_data(locations_df)
+    env.get_features()
+    env.train_models()
+    return env.get_forecasts(should_undo_normalize_cases=True)
+
+
+def test_parallel_forecasts_match_serial(tmp_path, monkeypatch):
+    # Settings changed in the parent process apply to the worker processes.
+    monkeypatch.setattr(LinearModel, "num_warmup", 50)
+    monkeypatch.setattr(LinearModel, "num_samples", 50)
+    serial = get_forecasts(tmp_path / "serial", n_jobs=1)
+    parallel = get_forecasts(tmp_path / "parallel", n_jobs=2)
+    assert list(serial) == list(parallel)
+    for key, (instance_date, predictions, predictions_proba) in serial.items():
+        assert parallel[key][0] == instance_date
+        np.testing.assert_array_equal(parallel[key][1], predictions)
+        pd.testing.assert_frame_equal(parallel[key][2], predictions_proba)